@@ -1,16 +1,22 @@
 #!/usr/bin/env python
 
 import cProfile, pstats, io
-from src.models.file import FileLikeObject, session
+from src.models import file as file_model
+from src.models.file import FileLikeObject, DatabaseSetting
+from src.models.dedupe import TieredDeduper
+from src.models.paths import migrate_to_compact, is_compact
+from src.models.similar import near_duplicate_images
+from src.models.merge import merge_shards
+from src.models.watch import Watcher
 import datetime
 import argparse
+import json
 
 
 import logging
 import python_logging_base
 from python_logging_base import ASSERT, TODO
 
-python_logging_base.example_logs()
 LOG = logging.getLogger("fs_buddy")
 
 
@@ -19,17 +25,59 @@ if __name__ == "__main__":
 
 
     parser = argparse.ArgumentParser(prog = "FS Buddy", description=f'Batch tools for managing a mess of files')
-    parser.add_argument("directories", metavar='DIRECTORY', type=str, nargs='+')
+    parser.add_argument("directories", metavar='DIRECTORY', type=str, nargs='*')
+    parser.add_argument("--db", help="The DB to scan into (default $FS_BUDDY_DB, or file_metadata.sqlite here)")
+    parser.add_argument("--host", help="Record scans as being of this host (remembered by the DB; default the hostname), so DBs from several hosts can be merged")
+    parser.add_argument("--merge", metavar="SHARD", nargs="+", help="Import these DBs, each scanned on its own host, into --db")
+    parser.add_argument("--incremental", action="store_true", help="Don't re-fingerprint files whose stat matches what's stored")
+    parser.add_argument("--resume", action="store_true", help="Pick up an interrupted scan of the same directory, skipping the subtrees it finished")
+    parser.add_argument("--bulk", action="store_true", help="Look up known rows a directory at a time and write in batches instead of row by row")
+    parser.add_argument("--batch-size", type=int, default=None, help="Rows per commit (per executemany with --bulk)")
+    parser.add_argument("--workers", type=int, default=None, help="Fingerprint on a pool of this many workers while walking and writing (implies --bulk)")
+    parser.add_argument("--processes", action="store_true", help="Use worker processes rather than threads for --workers")
+    parser.add_argument("--defer-fingerprints", action="store_true", help="Don't content hash during the scan; leave it to --dedupe")
+    parser.add_argument("--phases-json", help="Write each scan's per-phase timings (lstat, magic, imohash, commit...) to this file as JSON")
+    parser.add_argument("--compact-paths", action="store_true", help="Convert the DB to store names and parents instead of full paths, before scanning")
+    parser.add_argument("--dedupe", action="store_true", help="After scanning, confirm duplicates by size, then imohash, then full hash")
+    parser.add_argument("--similar-images", type=int, metavar="BITS", default=None, help="After scanning, list pairs of images whose perceptual hashes differ in at most this many bits")
+    parser.add_argument("--watch", action="store_true", help="After everything else, keep the DB up to date with changes under the directories until interrupted (Linux only)")
 
     args = parser.parse_args()
+    file_model.session = file_model.bind_file_db(args.db)
+    session = file_model.session
+    if args.host:
+        DatabaseSetting.put(session, DatabaseSetting.HOST_SETTING, args.host)
+
+    if args.compact_paths and not is_compact(session):
+        migrate_to_compact(session.get_bind())
+    if args.merge:
+        merge_shards(session.get_bind(), args.merge)
+
+    watcher = None
+    if args.watch:
+        # Watches first, so that changes made during the scan below are caught and it needn't be repeated.
+        watcher = Watcher(session, args.directories)
+        watcher.start(scan=False)
 
     pr = cProfile.Profile()
     pr.enable()
+    phases = {}
     for d in args.directories:
         new_file = FileLikeObject(
                 path = d
                 )
-        FileLikeObject.scan_recursively(new_file)
+        progress = FileLikeObject.scan_recursively(new_file, incremental=args.incremental, bulk=args.bulk, batch_size=args.batch_size,
+                workers=args.workers, use_processes=args.processes, defer_fingerprints=args.defer_fingerprints,
+                resume=args.resume)
+        phases[d] = progress.instruments.as_dict()
+    if args.phases_json:
+        with open(args.phases_json, 'w') as f:
+            json.dump(phases, f, indent=2)
+    if args.dedupe:
+        TieredDeduper(session).run()
+    if args.similar_images != None:
+        for (a, b, distance) in near_duplicate_images(session, args.similar_images):
+            LOG.info(f"{distance:2d} bits apart: {a} and {b}")
     pr.disable()
 
     s = io.StringIO()
@@ -40,3 +88,11 @@ if __name__ == "__main__":
         print(s.getvalue(), file=f)
 
     LOG.info("Printed stats to perf.txt")
+
+    if watcher != None:
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            LOG.info("Stopped watching")
+        finally:
+            watcher.close()
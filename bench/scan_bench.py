@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the scan and dedupe hot paths over a generated tree (see bench.synthetic_tree).
+
+    python -m bench.scan_bench --files 5000 --output bench.json
+    python -m bench.scan_bench --files 5000 --compare bench.json
+
+Each repeat starts from an empty in-memory DB and runs, in order: a full scan, a rescan of the
+unchanged tree, the view_duplicates query, and the duplicate folder queries. Results are JSON;
+--compare exits non-zero if any phase got slower than a previous result by more than --tolerance.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import statistics
+import subprocess
+import tempfile
+import argparse
+import sqlalchemy
+
+from src.models import file as file_model
+from src.models.file import FileLikeObject, DuplicateView
+from bench.synthetic_tree import TreeSpec, generate
+
+import logging
+import python_logging_base
+from python_logging_base import ASSERT, TODO
+
+LOG = logging.getLogger("scan_bench")
+
+
+def bytes_read():
+    """
+    Bytes this process has read through read() and friends so far (Linux only; None elsewhere).
+    Reads made by worker processes aren't included.
+    """
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class PhaseTiming(object):
+    """
+    One timed run of one phase.
+    """
+    def __init__(self, name, files):
+        self.name = name
+        self.files = files          # Entries the phase covers, for files per second
+        self.rows = None            # Rows the phase returned, for the queries
+        self.instrumentation = None # Instruments.as_dict() from the scans
+        self.seconds = None
+        self.bytes_read = None
+
+    def __enter__(self):
+        self.start_bytes = bytes_read()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time.perf_counter() - self.start
+        end_bytes = bytes_read()
+        if self.start_bytes != None and end_bytes != None:
+            self.bytes_read = end_bytes - self.start_bytes
+        return False
+
+
+def run_once(root, scan_options):
+    """
+    Fresh DB, then every phase once. Returns a list of PhaseTiming.
+    """
+    file_model.session = file_model.bind_in_memory_db()
+    timings = []
+    with PhaseTiming("scan", None) as timing:
+        progress = FileLikeObject.scan_recursively(FileLikeObject(path=root), **scan_options)
+    timing.files = progress.files_processed
+    timing.instrumentation = progress.instruments.as_dict()
+    timings.append(timing)
+    with PhaseTiming("rescan_unchanged", None) as timing:
+        progress = FileLikeObject.scan_recursively(FileLikeObject(path=root), **dict(scan_options, incremental=True))
+    timing.files = progress.files_processed
+    timing.instrumentation = progress.instruments.as_dict()
+    timings.append(timing)
+    with PhaseTiming("view_duplicates", progress.files_processed) as timing:
+        timing.rows = len(file_model.session.execute(sqlalchemy.select(DuplicateView.__table__)).all())
+    timings.append(timing)
+    with PhaseTiming("scan_for_duplicate_folders", progress.files_processed) as timing:
+        timing.rows = len(DuplicateView.scan_for_duplicate_folders())
+    timings.append(timing)
+    with PhaseTiming("identical_folders", progress.files_processed) as timing:
+        timing.rows = len(list(DuplicateView.identical_folders()))
+    timings.append(timing)
+    file_model.session.close()
+    return timings
+
+
+def summarize(runs):
+    """
+    Per phase, the median over repeats of seconds and of bytes read, and the rates from those.
+    """
+    phases = {}
+    for name in [timing.name for timing in runs[0]]:
+        timings = [timing for run in runs for timing in run if timing.name == name]
+        seconds = statistics.median(timing.seconds for timing in timings)
+        read = [timing.bytes_read for timing in timings if timing.bytes_read != None]
+        read = statistics.median(read) if len(read) > 0 else None
+        files = timings[0].files
+        phases[name] = {
+            "files": files,
+            "rows": timings[0].rows,
+            "seconds": seconds,
+            "seconds_all": [timing.seconds for timing in timings],
+            "files_per_second": files / seconds if seconds > 0 else None,
+            "bytes_read": read,
+            "bytes_read_per_second": read / seconds if read != None and seconds > 0 else None,
+            "instrumentation": timings[0].instrumentation,
+        }
+    return phases
+
+
+def revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(spec, scan_options, repeat=3, tree=None):
+    """
+    Generate the tree (or reuse it, if tree names a directory that exists) and benchmark it.
+    Returns the result as a dict ready for JSON.
+    """
+    with tempfile.TemporaryDirectory(prefix="fs_buddy_bench_") as scratch:
+        root = os.path.abspath(tree) if tree != None else os.path.join(scratch, "tree")
+        tree_stats = None
+        if not os.path.exists(root):
+            tree_stats = generate(root, spec).as_dict()
+        saved_session = file_model.session
+        try:
+            runs = [run_once(root, scan_options) for _ in range(repeat)]
+        finally:
+            file_model.session = saved_session
+    return {
+        "revision": revision(),
+        "python": platform.python_version(),
+        "sqlalchemy": sqlalchemy.__version__,
+        "platform": platform.platform(),
+        "spec": spec.as_dict(),
+        "tree": tree_stats,
+        "scan_options": scan_options,
+        "repeat": repeat,
+        "phases": summarize(runs),
+    }
+
+
+def regressions(result, baseline, tolerance):
+    """
+    (phase, old seconds, new seconds) for every phase that's more than tolerance slower than in baseline.
+    Only meaningful when both were run over the same spec.
+    """
+    if result["spec"] != baseline["spec"]:
+        LOG.warning("Comparing results from different tree specs")
+    slower = []
+    for name, phase in result["phases"].items():
+        old = baseline["phases"].get(name)
+        if old != None and phase["seconds"] > old["seconds"] * (1 + tolerance):
+            slower.append((name, old["seconds"], phase["seconds"]))
+    return slower
+
+
+if __name__ == "__main__":
+    defaults = TreeSpec()
+    parser = argparse.ArgumentParser(prog="fs_buddy bench", description="Benchmark scans and duplicate queries over a synthetic tree")
+    parser.add_argument("--files", type=int, default=defaults.files)
+    parser.add_argument("--depth", type=int, default=defaults.depth)
+    parser.add_argument("--fanout", type=int, default=defaults.fanout)
+    parser.add_argument("--median-bytes", type=int, default=defaults.median_bytes)
+    parser.add_argument("--size-sigma", type=float, default=defaults.size_sigma)
+    parser.add_argument("--max-bytes", type=int, default=defaults.max_bytes)
+    parser.add_argument("--duplicate-ratio", type=float, default=defaults.duplicate_ratio)
+    parser.add_argument("--duplicate-folders", type=int, default=defaults.duplicate_folders)
+    parser.add_argument("--jpeg-ratio", type=float, default=defaults.jpeg_ratio)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--tree", help="Generate the tree here and keep it (or reuse it, if it exists) instead of in a temporary directory")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per phase; the median is reported")
+    parser.add_argument("--bulk", action="store_true")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--processes", action="store_true")
+    parser.add_argument("--defer-fingerprints", action="store_true")
+    parser.add_argument("--output", help="Write the JSON result here rather than to stdout")
+    parser.add_argument("--compare", help="A previous JSON result to check for regressions against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed slowdown per phase for --compare, as a fraction")
+    args = parser.parse_args()
+
+    spec = TreeSpec(files=args.files, depth=args.depth, fanout=args.fanout, median_bytes=args.median_bytes,
+            size_sigma=args.size_sigma, max_bytes=args.max_bytes, duplicate_ratio=args.duplicate_ratio,
+            duplicate_folders=args.duplicate_folders, jpeg_ratio=args.jpeg_ratio, seed=args.seed)
+    scan_options = {"bulk": args.bulk, "workers": args.workers, "use_processes": args.processes,
+            "defer_fingerprints": args.defer_fingerprints}
+    result = run(spec, scan_options, args.repeat, args.tree)
+    output = json.dumps(result, indent=2)
+    if args.output != None:
+        with open(args.output, "w") as f:
+            print(output, file=f)
+        LOG.info(f"Wrote results to {args.output}")
+    else:
+        print(output)
+    if args.compare != None:
+        with open(args.compare) as f:
+            slower = regressions(result, json.load(f), args.tolerance)
+        for (name, old, new) in slower:
+            LOG.error(f"{name} regressed: {old:.3f}s => {new:.3f}s")
+        sys.exit(1 if len(slower) > 0 else 0)
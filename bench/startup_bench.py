@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+Benchmarks for how long the command line tools take to start, each run as a fresh interpreter.
+
+    python -m bench.startup_bench --output startup.json
+    python -m bench.startup_bench --compare startup.json
+
+Times, as the median over --repeat runs: a bare interpreter (the floor), importing the models,
+`app.py --help`, and a one-row query against an empty DB. Also records which of the heavy optional
+dependencies importing the models pulls in, which should be none of them. Results are JSON in the
+same shape as bench.scan_bench's, and --compare works the same way.
+"""
+import os
+import sys
+import json
+import time
+import platform
+import statistics
+import subprocess
+import tempfile
+import argparse
+
+from bench.scan_bench import revision, regressions
+
+import logging
+import python_logging_base
+from python_logging_base import ASSERT, TODO
+
+LOG = logging.getLogger("startup_bench")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Only needed once a scan or enrichment actually reads files.
+HEAVY_MODULES = ["PIL", "magic", "imohash"]
+
+
+def commands(db):
+    """
+    name => argv for each phase, run from a scratch directory so nothing can lean on the working directory.
+    """
+    return {
+        "python": [sys.executable, "-c", "pass"],
+        "import_models": [sys.executable, "-c", "import src.models.file, src.models.reports"],
+        "app_help": [sys.executable, os.path.join(ROOT, "app.py"), "--help"],
+        "query": [sys.executable, os.path.join(ROOT, "query.py"), "largest", "--limit", "1", "--db", db],
+    }
+
+
+def environment():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([ROOT] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+    return env
+
+
+def time_command(argv, cwd, env):
+    start = time.perf_counter()
+    subprocess.run(argv, cwd=cwd, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def heavy_modules_loaded(cwd, env):
+    """
+    Which of HEAVY_MODULES importing the models loads.
+    """
+    script = f"import sys, json, src.models.file, src.models.reports; print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+    return json.loads(subprocess.run([sys.executable, "-c", script], cwd=cwd, env=env, check=True,
+            capture_output=True, text=True).stdout)
+
+
+def run(repeat=10):
+    """
+    Returns the result as a dict ready for JSON.
+    """
+    env = environment()
+    with tempfile.TemporaryDirectory(prefix="fs_buddy_startup_") as scratch:
+        db = os.path.join(scratch, "startup.sqlite")
+        # Create it up front, so the query phase times opening a DB rather than creating one.
+        subprocess.run([sys.executable, "-c", f"import src.models.file as f; f.bind_file_db({db!r})"], cwd=scratch, env=env, check=True,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        phases = {}
+        for name, argv in commands(db).items():
+            time_command(argv, scratch, env)        # Warm the page cache and the bytecode cache
+            seconds_all = [time_command(argv, scratch, env) for _ in range(repeat)]
+            phases[name] = {"seconds": statistics.median(seconds_all), "seconds_all": seconds_all}
+        heavy = heavy_modules_loaded(scratch, env)
+        stray = sorted(set(os.listdir(scratch)) - {"startup.sqlite"})
+    return {
+        "revision": revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "spec": None,
+        "repeat": repeat,
+        "phases": phases,
+        "heavy_modules_on_import": heavy,
+        "files_left_in_working_directory": stray,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="fs_buddy startup bench", description="Benchmark how long the command line tools take to start")
+    parser.add_argument("--repeat", type=int, default=10, help="Runs per phase; the median is reported")
+    parser.add_argument("--output", help="Write the JSON result here rather than to stdout")
+    parser.add_argument("--compare", help="A previous JSON result to check for regressions against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown per phase for --compare, as a fraction")
+    args = parser.parse_args()
+
+    result = run(args.repeat)
+    output = json.dumps(result, indent=2)
+    if args.output != None:
+        with open(args.output, "w") as f:
+            print(output, file=f)
+        LOG.info(f"Wrote results to {args.output}")
+    else:
+        print(output)
+    if result["heavy_modules_on_import"]:
+        LOG.warning(f"Importing the models loads {', '.join(result['heavy_modules_on_import'])}")
+    if args.compare != None:
+        with open(args.compare) as f:
+            slower = regressions(result, json.load(f), args.tolerance)
+        for (name, old, new) in slower:
+            LOG.error(f"{name} regressed: {old:.3f}s => {new:.3f}s")
+        sys.exit(1 if len(slower) > 0 else 0)
@@ -0,0 +1,117 @@
+import os
+import math
+import random
+import shutil
+from PIL import Image
+
+import logging
+import python_logging_base
+from python_logging_base import ASSERT, TODO
+
+LOG = logging.getLogger("synthetic_tree")
+
+
+class TreeSpec(object):
+    """
+    The shape of a generated tree. Everything is drawn from one seeded RNG, so the same spec always
+    produces the same tree (the same bytes, not just the same counts).
+    """
+    def __init__(self, files=1000, depth=3, fanout=4, median_bytes=16384, size_sigma=1.5, max_bytes=1 << 24,
+            duplicate_ratio=0.1, duplicate_folders=2, jpeg_ratio=0.1, seed=1):
+        self.files = files                          # Regular files, not counting duplicate_folders copies
+        self.depth = depth                          # Levels of directories below the root
+        self.fanout = fanout                        # Subdirectories per directory
+        self.median_bytes = median_bytes            # File sizes are lognormal around this...
+        self.size_sigma = size_sigma                # ...with this shape, and capped at max_bytes
+        self.max_bytes = max_bytes
+        self.duplicate_ratio = duplicate_ratio      # Share of files that are a copy of an earlier file
+        self.duplicate_folders = duplicate_folders  # Leaf directories copied whole, for scan_for_duplicate_folders
+        self.jpeg_ratio = jpeg_ratio                # Share of (non-duplicate) files that are JPEGs with EXIF
+        self.seed = seed
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+class TreeStats(object):
+    """
+    What generate() actually wrote.
+    """
+    def __init__(self):
+        self.files = 0
+        self.directories = 0
+        self.bytes = 0
+        self.duplicates = 0
+        self.jpegs = 0
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+def directories_for(root, spec):
+    """
+    Every directory of a complete fanout-ary tree spec.depth deep under root, breadth first, root included.
+    """
+    directories = [root]
+    level = [root]
+    for depth in range(spec.depth):
+        level = [os.path.join(parent, f"d{depth}_{i}") for parent in level for i in range(spec.fanout)]
+        directories.extend(level)
+    return directories
+
+
+def jpeg_with_exif(path, rng):
+    image = Image.new("RGB", (64, 48), tuple(rng.randrange(256) for _ in range(3)))
+    exif = Image.Exif()
+    exif[0x010F] = "fs_buddy"                                   # Make
+    exif[0x0110] = f"Synthetic {rng.randrange(10)}"             # Model
+    exif[0x0132] = f"20{rng.randrange(10, 24)}:{rng.randrange(1, 13):02d}:{rng.randrange(1, 29):02d} 12:00:00"  # DateTime
+    image.save(path, "JPEG", exif=exif)
+
+
+def random_bytes(rng, size):
+    return rng.getrandbits(8 * size).to_bytes(size, "little") if size > 0 else b""
+
+
+def generate(root, spec):
+    """
+    Write a tree shaped by spec under root (which must not exist yet). Files are spread round robin
+    over every directory, so both inner and leaf directories have some. Returns TreeStats.
+    """
+    rng = random.Random(spec.seed)
+    stats = TreeStats()
+    directories = directories_for(root, spec)
+    for directory in directories:
+        os.mkdir(directory)
+    stats.directories = len(directories)
+    written = []
+    for n in range(spec.files):
+        directory = directories[n % len(directories)]
+        if len(written) > 0 and rng.random() < spec.duplicate_ratio:
+            source = rng.choice(written)
+            path = os.path.join(directory, f"f{n}_copy{os.path.splitext(source)[1]}")
+            shutil.copyfile(source, path)
+            stats.duplicates += 1
+        elif rng.random() < spec.jpeg_ratio:
+            path = os.path.join(directory, f"f{n}.jpg")
+            jpeg_with_exif(path, rng)
+            stats.jpegs += 1
+        else:
+            path = os.path.join(directory, f"f{n}.bin")
+            size = min(int(rng.lognormvariate(math.log(spec.median_bytes), spec.size_sigma)), spec.max_bytes)
+            with open(path, "wb") as f:
+                f.write(random_bytes(rng, size))
+        written.append(path)
+        stats.files += 1
+        stats.bytes += os.lstat(path).st_size
+    # Whole-directory copies, so identical folders exist to be found.
+    leaves = directories[len(directories) - spec.fanout ** spec.depth:]
+    for n, leaf in enumerate(rng.sample(leaves, min(spec.duplicate_folders, len(leaves)))):
+        copy = os.path.join(root, f"copy{n}_{os.path.basename(leaf)}")
+        shutil.copytree(leaf, copy)
+        for entry in os.scandir(copy):
+            stats.files += 1
+            stats.bytes += entry.stat(follow_symlinks=False).st_size
+        stats.directories += 1
+    LOG.info(f"Generated {stats.files} files ({stats.bytes} bytes) in {stats.directories} directories under {root}")
+    return stats
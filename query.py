@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""
+Reports over a scanned DB, streamed as JSON Lines or CSV:
+
+    python query.py duplicates --limit 100
+    python query.py largest --files --format csv --output largest.csv
+    python query.py folders --db other.sqlite
+"""
+import os
+import sys
+import itertools
+import argparse
+
+from src.models.reports import REPORTS, WRITERS, PAGE_SIZE, open_read_only
+
+import logging
+import python_logging_base
+from python_logging_base import ASSERT, TODO
+
+LOG = logging.getLogger("query")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="FS Buddy query", description="Stream reports over a scanned DB")
+    subparsers = parser.add_subparsers(dest="report", required=True)
+    descriptions = {
+        "duplicates": "Every file in a duplicate group, the groups that would free the most space first",
+        "largest": "Directories by total size, biggest first",
+        "folders": "Directories whose whole trees are identical, biggest first",
+    }
+    for name in REPORTS:
+        subparser = subparsers.add_parser(name, help=descriptions[name])
+        subparser.add_argument("--db", help="The DB to query (default $FS_BUDDY_DB, or file_metadata.sqlite here)")
+        subparser.add_argument("--format", choices=sorted(WRITERS), default="jsonl")
+        subparser.add_argument("--output", help="Write here rather than to stdout")
+        subparser.add_argument("--limit", type=int, default=None, help="Stop after this many rows")
+        subparser.add_argument("--page-size", type=int, default=PAGE_SIZE, help="Rows fetched per query")
+        if name == "largest":
+            subparser.add_argument("--files", action="store_true", help="List files as well as directories")
+    args = parser.parse_args()
+
+    # Read-only, and without src.models.file: a report never creates, upgrades or writes to the DB.
+    db = args.db if args.db != None else os.environ.get("FS_BUDDY_DB", "file_metadata.sqlite")
+    try:
+        connection = open_read_only(db)
+    except FileNotFoundError as e:
+        LOG.error(str(e))
+        sys.exit(1)
+    if args.report == "largest":
+        report = REPORTS[args.report](args.page_size, files=args.files)
+    else:
+        report = REPORTS[args.report](args.page_size)
+    rows = report.rows(connection)
+    if args.limit != None:
+        rows = itertools.islice(rows, args.limit)
+    out = open(args.output, "w", newline="") if args.output else sys.stdout
+    try:
+        count = WRITERS[args.format](report.columns, rows, out)
+    finally:
+        if args.output:
+            out.close()
+    LOG.info(f"Wrote {count} {args.report} rows")
@@ -0,0 +1,170 @@
+import hashlib
+import itertools
+
+from sqlalchemy import select, update, func
+
+from src.models.file import FileLikeObject
+
+import logging
+import python_logging_base
+from python_logging_base import ASSERT, TODO
+
+LOG = logging.getLogger("dedupe")
+
+
+def full_content_hash(path, chunk_bytes=1 << 20):
+    """
+    sha256 of the whole file, streamed through one reused buffer.
+    """
+    digest = hashlib.sha256()
+    buffer = bytearray(chunk_bytes)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            read = f.readinto(buffer)
+            if not read:
+                break
+            digest.update(view[:read])
+    return digest.hexdigest()
+
+
+class DedupeReport(object):
+    """
+    What a TieredDeduper run did, tier by tier.
+    """
+    def __init__(self):
+        self.size_groups = 0            # Tier 1: sizes shared by more than one file
+        self.sampled = 0                # Tier 2: files imohashed because their size collided
+        self.full_hashed = 0            # Tier 3: files fully hashed because their imohash collided
+        self.confirmed_groups = 0       # Sets of files with identical content
+        self.confirmed_files = 0
+        self.wasted_bytes = 0           # Bytes that could be reclaimed keeping one copy per group
+
+    def __repr__(self):
+        return f"<DedupeReport {self.size_groups} size groups, {self.sampled} sampled, {self.full_hashed} fully hashed, " \
+                f"{self.confirmed_files} files in {self.confirmed_groups} confirmed groups, {self.wasted_bytes} bytes wasted>"
+
+
+class TieredDeduper(object):
+    """
+    Duplicate confirmation over the filelikes table, reading as little file content as possible:
+
+    1. Group regular files by tree_size_bytes. A file with a unique size can't have a duplicate and is never read.
+    2. Within a size group, compare imohash fingerprints, computing (and storing) them only where missing.
+    3. Within an imohash collision, hash the whole content and store it as FULL_FINGERPRINT_TYPE.
+       Only these rows are confirmed duplicates, safe to delete from.
+
+    Rows with an "error" fingerprint (e.g. broken images) are left alone. Afterwards the subtree
+    fingerprints above every file that got a new fingerprint are recomputed, so identical folders
+    are found after a scan with defer_fingerprints too.
+    """
+    def __init__(self, session, batch_size=1000, chunk_bytes=1 << 20):
+        from src.models.paths import PathResolver
+        self.session = session
+        self.resolver = PathResolver(session)
+        self.batch_size = batch_size
+        self.chunk_bytes = chunk_bytes
+        self.updates = []
+        self.changed_directories = set()    # Parents of the rows given a new fingerprint
+
+    @staticmethod
+    def candidates():
+        """
+        SQL criteria for the rows dedupe considers: regular files without an error fingerprint.
+        """
+        return (FileLikeObject.directory == False) & \
+                FileLikeObject.permissions.startswith("-") & \
+                ((FileLikeObject.fingerprint_type == None) | (FileLikeObject.fingerprint_type != "error"))
+
+    def run(self):
+        report = DedupeReport()
+        sizes = [size for (size,) in self.session.execute(
+            select(FileLikeObject.tree_size_bytes).where(TieredDeduper.candidates()).
+            group_by(FileLikeObject.tree_size_bytes).having(func.count() > 1))]
+        LOG.info(f"{len(sizes)} file sizes are shared by more than one file")
+        for size in sizes:
+            report.size_groups += 1
+            members = self.session.execute(
+                select(FileLikeObject.id, FileLikeObject.path, FileLikeObject.parent_id, FileLikeObject.name,
+                    FileLikeObject.fingerprint, FileLikeObject.fingerprint_type).
+                where(TieredDeduper.candidates()).where(FileLikeObject.tree_size_bytes == size)).all()
+            self.confirm_size_group(size, members, report)
+        self.flush()
+        FileLikeObject.refresh_subtree_fingerprints(self.session, self.changed_directories)
+        self.session.commit()
+        LOG.info(f"Dedupe done: {report}")
+        return report
+
+    def confirm_size_group(self, size, members, report):
+        # Tier 2. Fully hashed rows still get compared by imohash (computed but not stored) so that a
+        # newly scanned copy of a confirmed duplicate is recognized.
+        import imohash
+        sampled = []
+        for member in members:
+            if member.fingerprint_type == FileLikeObject.SAMPLED_FINGERPRINT_TYPE:
+                sampled.append((member.fingerprint, member))
+                continue
+            path = self.resolver.full_path(member)
+            try:
+                fingerprint = imohash.hashfile(path, hexdigest=True)
+            except OSError as e:
+                LOG.error(f"Could not read {path} to fingerprint it: {e}")
+                continue
+            report.sampled += 1
+            if member.fingerprint == None:
+                self.update(member, fingerprint, FileLikeObject.SAMPLED_FINGERPRINT_TYPE)
+            sampled.append((fingerprint, member))
+        sampled.sort(key=lambda pair: pair[0])
+        # Tier 3
+        for _, group in itertools.groupby(sampled, key=lambda pair: pair[0]):
+            group = [member for (_, member) in group]
+            if len(group) < 2:
+                continue
+            full = {}
+            for member in group:
+                if member.fingerprint_type == FileLikeObject.FULL_FINGERPRINT_TYPE:
+                    full.setdefault(member.fingerprint, []).append(member)
+                    continue
+                path = self.resolver.full_path(member)
+                try:
+                    fingerprint = full_content_hash(path, self.chunk_bytes)
+                except OSError as e:
+                    LOG.error(f"Could not read {path} to hash it: {e}")
+                    continue
+                report.full_hashed += 1
+                self.update(member, fingerprint, FileLikeObject.FULL_FINGERPRINT_TYPE)
+                full.setdefault(fingerprint, []).append(member)
+            for copies in full.values():
+                if len(copies) > 1:
+                    report.confirmed_groups += 1
+                    report.confirmed_files += len(copies)
+                    report.wasted_bytes += size * (len(copies) - 1)
+
+    def update(self, member, fingerprint, fingerprint_type):
+        self.updates.append({"id": member.id, "fingerprint": fingerprint, "fingerprint_type": fingerprint_type})
+        self.changed_directories.add(member.parent_id)
+        if len(self.updates) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.updates) > 0:
+            self.session.execute(update(FileLikeObject), self.updates)
+            self.updates = []
+        self.session.commit()
+
+    @staticmethod
+    def confirmed_duplicates(session):
+        """
+        Yields (fingerprint, tree_size_bytes, [paths]) for every set of files confirmed identical by a full hash.
+        """
+        from src.models.paths import PathResolver
+        resolver = PathResolver(session)
+        rows = session.execute(
+            select(FileLikeObject.fingerprint, FileLikeObject.tree_size_bytes, FileLikeObject.path, FileLikeObject.parent_id, FileLikeObject.name,
+                FileLikeObject.host).
+            where(FileLikeObject.fingerprint_type == FileLikeObject.FULL_FINGERPRINT_TYPE).
+            order_by(FileLikeObject.fingerprint))
+        for fingerprint, group in itertools.groupby(rows, key=lambda row: row.fingerprint):
+            group = list(group)
+            if len(group) > 1:
+                yield (fingerprint, group[0].tree_size_bytes, sorted(resolver.located(row, resolver.full_path(row)) for row in group))
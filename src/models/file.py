@@ -1,17 +1,16 @@
 import os
 import stat
-import sys
 import re
 import datetime
-import magic
-import imohash          # imohash is a fast nearly-file-size-independent sampling hash algorithm.
-import subprocess
-import pathlib
-from PIL import Image, ExifTags
+import time
+import json
+import hashlib
+import itertools
+import zlib
+import socket
 
 from sqlalchemy import Column, ForeignKey, Integer, BigInteger, String, DateTime, Boolean, Numeric
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, backref, sessionmaker
+from sqlalchemy.orm import declarative_base, relationship, backref, sessionmaker
 from sqlalchemy import create_engine
 from sqlalchemy.sql import text
 import sqlalchemy
@@ -24,6 +23,7 @@ from python_logging_base import ASSERT, TODO
 
 LOG = logging.getLogger("flo")
 LOG.level = logging.DEBUG
+TRACE = logging.getLevelName("TRACE")     # The level python_logging_base adds for LOG.trace
 
 PILLog = logging.getLogger("PIL.TiffImagePlugin")
 PILLog.level = logging.INFO
@@ -34,10 +34,18 @@ flo_scan_cache = {}
 
 class FileLikeObject(Base):
     __tablename__ = 'filelikes'
+    __table_args__ = (
+            # Per-directory lookups (and recursive CTEs down the tree) are range scans on this.
+            sqlalchemy.Index("ix_filelikes_parent_id_name", "parent_id", "name"),
+            # Keyset pages of src.models.reports.DuplicateFoldersReport are ranges on this; only directories have subtree fingerprints.
+            sqlalchemy.Index("ix_filelikes_tree_size_bytes_subtree_fingerprint", "tree_size_bytes", "subtree_fingerprint",
+                    sqlite_where=text("subtree_fingerprint IS NOT NULL")),
+            )
     id = Column(Integer, primary_key=True)
     parent_id = Column(Integer, ForeignKey('filelikes.id'))
     last_stat = Column(DateTime, nullable=False)                # When we last looked at the file
-    path = Column(String(4096), index=True, nullable=False)     # The filename; max size is from extfs
+    path = Column(String(4096), index=True)                     # The full path; max size is from extfs. NULL in a compact_paths DB.
+    name = Column(String(4096))                                 # Basename under parent_id; the whole absolute path for rows with no parent
     permissions = Column(String(12), nullable=False)            # Permissions in human-readable string 
     tree_size_bytes = Column(BigInteger, index=True)            # The size of the whole subtree (for files, size of self)
     directory = Column(Boolean, default=False)                  # True for directories
@@ -49,14 +57,51 @@ class FileLikeObject(Base):
     last_access = Column(DateTime, index=False)
     last_modified = Column(DateTime, index=True)
     creation_or_meta = Column(DateTime, index=True)
+    subtree_fingerprint = Column(String(64), index=True)        # Directories only: Merkle hash of the sorted child names and fingerprints.
+    host = Column(String(255), index=True)                      # The machine that scanned this (see DatabaseSetting.host); with dev_number, the volume
     children = relationship('FileLikeObject',
             backref=backref('parent', remote_side=[id]))
     image_meta = relationship('ImageMetadata', uselist=False,
             backref=backref('file', remote_side=[id]))
 
-    def fs_refresh(self):
+    # What fs_refresh ended up doing
+    REFRESH_STAT_ONLY = "stat_only"             # Not a regular file; only stat data to collect
+    REFRESH_FINGERPRINTED = "fingerprinted"     # Regular file; mime, fingerprint and image metadata (re)computed
+    REFRESH_SKIPPED = "skipped"                 # Incremental and unchanged; only last_stat was bumped
+
+    # fingerprint_type values
+    SAMPLED_FINGERPRINT_TYPE = "imohash_default_hex"    # Fast, samples the file; a match is a probable duplicate
+    FULL_FINGERPRINT_TYPE = "sha256_hex"                # Whole content; a match is a confirmed duplicate
+
+    def stat_unchanged(self, f_stat):
+        """
+        True if this (already stored) row still describes the file behind f_stat.
+        If nothing we key off of has moved, the stored mime, fingerprint and image metadata are still good.
+        """
+        if self.id == None or self.directory:
+            return False
+        return self.dev_number == f_stat[stat.ST_DEV] and \
+                self.inode == f_stat[stat.ST_INO] and \
+                self.tree_size_bytes == f_stat[stat.ST_SIZE] and \
+                self.last_modified == datetime.datetime.fromtimestamp(f_stat[stat.ST_MTIME]) and \
+                self.creation_or_meta == datetime.datetime.fromtimestamp(f_stat[stat.ST_CTIME])
+
+    def fs_refresh(self, incremental=False):
         """
         Refresh the file like information on the filesystem.
+        If incremental, a stored row whose stat still matches the disk only gets last_stat bumped.
+        Returns one of the REFRESH_* values saying how much work was done.
+        """
+        refreshed = self.refresh_stat(incremental)
+        if refreshed == FileLikeObject.REFRESH_FINGERPRINTED:
+            self.apply_fingerprint(FileLikeObject.fingerprint_file(self.path))
+        return refreshed
+
+    def refresh_stat(self, incremental=False):
+        """
+        The cheap half of fs_refresh: lstat and the fields that come from it.
+        Returns REFRESH_FINGERPRINTED when this is a regular file whose content still needs
+        fingerprint_file / apply_fingerprint run on it.
         """
         # Get the absolute path just to be sure
         full_path = os.path.abspath(self.path)
@@ -65,113 +110,331 @@ class FileLikeObject(Base):
         # Stat that sucker
         f_stat = os.lstat(self.path)
         self.last_stat = datetime.datetime.now()
+        if incremental and self.stat_unchanged(f_stat):
+            if LOG.isEnabledFor(TRACE):
+                LOG.trace(f"Stats for file {self.path} unchanged; keeping stored fingerprint")
+            return FileLikeObject.REFRESH_SKIPPED
+        if stat.S_ISDIR(f_stat.st_mode): self.directory = True
+        self.permissions = stat.filemode(f_stat.st_mode)
+        self.inode = f_stat[stat.ST_INO]
+        self.dev_number = f_stat[stat.ST_DEV]
+        if not self.directory: self.tree_size_bytes = f_stat[stat.ST_SIZE]
+        # Directories will have tree sizes set on "unwind" of descending into all their children.
+        self.last_access = datetime.datetime.fromtimestamp(f_stat[stat.ST_ATIME])
+        self.last_modified = datetime.datetime.fromtimestamp(f_stat[stat.ST_MTIME])
+        self.creation_or_meta = datetime.datetime.fromtimestamp(f_stat[stat.ST_CTIME])
+        # Only build the trace strings if anyone will see them; this runs for every entry.
+        if LOG.isEnabledFor(TRACE):
+            self.trace_stat(f_stat)
+        # Finally, mime types and file hashes are due if we're a regular file (not a directory or symlink or pipe)
+        if stat.S_ISREG(f_stat.st_mode):
+            return FileLikeObject.REFRESH_FINGERPRINTED
+        return FileLikeObject.REFRESH_STAT_ONLY
+
+    def trace_stat(self, f_stat):
         LOG.trace(f"Stats for file {self.path} collected")
         LOG.trace(f"* Is a directory? {stat.S_ISDIR(f_stat.st_mode)}")
-        if stat.S_ISDIR(f_stat.st_mode): self.directory = True
         LOG.trace(f"* Is a regular file? {stat.S_ISREG(f_stat.st_mode)}")
         LOG.trace(f"* Is a symlink? {stat.S_ISLNK(f_stat.st_mode)}")
-        self.permissions = stat.filemode(f_stat.st_mode)
         LOG.trace(f"* Permissions bits? {oct(stat.S_IMODE(f_stat.st_mode))}, or {self.permissions}")
-        self.inode = f_stat[stat.ST_INO]
         LOG.trace(f"* Inode number? {self.inode}")
-        self.dev_number = f_stat[stat.ST_DEV]
         LOG.trace(f"* Device number? {self.dev_number}")
         LOG.trace(f"* User ID number? {f_stat[stat.ST_UID]}")
         LOG.trace(f"* Group ID number? {f_stat[stat.ST_GID]}")
-        if not self.directory: self.tree_size_bytes = f_stat[stat.ST_SIZE]
-        # Directories will have tree sizes set on "unwind" of descending into all their children.
         LOG.trace(f"* Size in bytes? {self.tree_size_bytes}")
-        self.last_access = datetime.datetime.fromtimestamp(f_stat[stat.ST_ATIME])
         LOG.trace(f"* Last access time? {self.last_access}")
-        self.last_modified = datetime.datetime.fromtimestamp(f_stat[stat.ST_MTIME])
         LOG.trace(f"* Last modification time? {self.last_modified}")
-        self.creation_or_meta = datetime.datetime.fromtimestamp(f_stat[stat.ST_CTIME])
         LOG.trace(f"* Creation/ last metadata change time? {self.creation_or_meta}")
-        # Finally, do mime types and file hashes if we're a regular file (not a directory or symlink or pipe)
-        if stat.S_ISREG(f_stat.st_mode):
-            self.mime = magic.from_file(self.path, mime=True)
-            LOG.trace(f"* Mime type: {self.mime}")
-            self.fingerprint_type = "imohash_default_hex"
-            self.fingerprint = imohash.hashfile(self.path, hexdigest=True)
-            LOG.trace(f"* Fingerprint ({self.fingerprint_type}): {self.fingerprint}")
-            if self.mime.startswith("image") and \
-                    not self.mime == "image/x-xcf":     # GIMP files don't have the same metadata
+
+    @staticmethod
+    def fingerprint_file(path, hash_content=True):
+        """
+        The expensive half of fs_refresh: everything that reads file content.
+        Only touches the filesystem, never the session, so it's safe to run on a worker thread or process.
+        Without hash_content the fingerprint is left NULL, for src.models.dedupe to fill in only where
+        the file size collides with another file.
+        Returns a plain dict for apply_fingerprint, with (phase, seconds, bytes_read) for each step
+        under "timings" (see src.models.instrumentation).
+        """
+        import magic
+        import imohash          # imohash is a fast nearly-file-size-independent sampling hash algorithm.
+        result = {"image_meta": None, "fingerprint_type": None, "fingerprint": None, "timings": []}
+        start = time.perf_counter()
+        result["mime"] = magic.from_file(path, mime=True)
+        result["timings"].append(("magic", time.perf_counter() - start, 0))
+        if LOG.isEnabledFor(TRACE):
+            LOG.trace(f"* Mime type: {result['mime']}")
+        if hash_content:
+            start = time.perf_counter()
+            with open(path, "rb") as f:
+                result["fingerprint"] = imohash.hashfileobject(f, hexdigest=True)
+                size = f.seek(0, os.SEEK_END)
+            result["fingerprint_type"] = FileLikeObject.SAMPLED_FINGERPRINT_TYPE
+            # imohash reads small files whole, and three samples of anything bigger.
+            read = size if size < imohash.imohash.SAMPLE_THRESHOLD else 3 * imohash.imohash.SAMPLE_SIZE
+            result["timings"].append(("imohash", time.perf_counter() - start, read))
+            if LOG.isEnabledFor(TRACE):
+                LOG.trace(f"* Fingerprint ({result['fingerprint_type']}): {result['fingerprint']}")
+        if result["mime"].startswith("image") and \
+                not result["mime"] == "image/x-xcf":     # GIMP files don't have the same metadata
+            start = time.perf_counter()
+            meta = ImageMetadata()
+            try:
+                meta.populate_from_file(path)
+            except Exception as e:
+                import traceback;
+                LOG.error(traceback.format_exc())
+                LOG.error("Setting fingerprint as \"error\"")
+                #import pdb; pdb.set_trace()
+                # Set the fingerprint to represent a broken file.
+                # The "fingerprint" will be the exception message.
+                result["fingerprint"] = str(e)
+                result["fingerprint_type"] = "error"
+            result["timings"].append(("exif", time.perf_counter() - start, 0))
+            if result["fingerprint_type"] != "error":
+                start = time.perf_counter()
                 try:
-                    meta = ImageMetadata(file = self)
-                    meta.populate_from_file()
-                    self.image_meta = meta
+                    meta.populate_perceptual_hash(path)
                 except Exception as e:
-                    import traceback;
-                    LOG.error(traceback.format_exc())
-                    LOG.error("Setting fingerprint as \"error\"")
-                    #import pdb; pdb.set_trace()
-                    # Set the fingerprint to represent a broken file.
-                    # The "fingerprint" will be the exception message.
-                    self.fingerprint = str(e)
-                    self.fingerprint_type = "error"
+                    # Not worth marking the file broken over; it just won't be found by similarity.
+                    LOG.error(f"Could not compute a perceptual hash of {path}: {e}")
+                result["timings"].append(("perceptual_hash", time.perf_counter() - start, 0))
+            result["image_meta"] = meta.column_values()
+        return result
 
+    def apply_fingerprint(self, result):
+        """
+        Set the results of fingerprint_file on this row.
+        """
+        self.mime = result["mime"]
+        self.fingerprint_type = result["fingerprint_type"]
+        self.fingerprint = result["fingerprint"]
+        if result["image_meta"] != None:
+            self.image_meta = ImageMetadata(**result["image_meta"])
 
     @staticmethod
-    def scan_recursively(file):
+    def existing_or_new(path, inode, host=None):
         """
-        Call this function from the outside.
-        Sets up recursion and ensures commits when we're done.
-        """
-        # This is the fastest way I know of to do this. Python iterating over directories
-        # is slower than even this redirect.
-
-        LOG.info(f"Counting files...")
-        find_sub = subprocess.Popen(("find", file.path), stdout=subprocess.PIPE)
-        output = subprocess.check_output(("wc", "-l"), stdin = find_sub.stdout)
-        find_sub.wait()
-        count = int(output.strip())
-        LOG.info(f"Processing approximately {count} files")
-        FileLikeObject.depth_first_recurse(file, count, 0, datetime.datetime.now())
-        # Since we might not have committed the last set on a non-round batch size, do so now.
-        session.commit()
+        Find the stored row for this path and inode (on host, if given), or make a new (unsaved) one.
+        """
+        # This is not a perfect check but collisions should be vanishingly rare.
+        # We really want unique per path and *device id*, but device id is not returned
+        # form os.scandir as a cached entry. However, on non-Windows, inode is documented
+        # as being returned. It would be a strong coincidence that a file has both the
+        # same path and inode on two different volumes; good enough for me.
+        query = session.query(FileLikeObject).filter(FileLikeObject.path == path).filter(FileLikeObject.inode == inode)
+        if host != None:
+            query = query.filter(FileLikeObject.on_host(host))
+        db_existing_entries = query.limit(2).all()
+        ASSERT(len(db_existing_entries) <= 1, f"Got more than one entry with path {path}")
+        if len(db_existing_entries) == 1:
+            return db_existing_entries[0]
+        return FileLikeObject(path=path)
+
+    def merkle_leaf(self):
+        """
+        What this entry contributes to its parent's subtree_fingerprint, or None if that's unknown
+        (a directory that couldn't be read, or one containing one).
+        A regular file that hasn't been content hashed (see defer_fingerprints) stands in by its size. That's
+        sound once src.models.dedupe.TieredDeduper has run, since it hashes every file whose size isn't unique,
+        and a file with a unique size can't make its directory identical to another; until then, such
+        directories may match on sizes alone.
+        """
+        if self.directory:
+            return self.subtree_fingerprint
+        if self.permissions.startswith("-"):
+            if self.fingerprint == None:
+                return f"size:{self.tree_size_bytes}"
+            return f"{self.fingerprint_type}:{self.fingerprint}"
+        # Symlinks, pipes, devices: all we have to go on is the kind and the size.
+        return f"{self.permissions[0]}:{self.tree_size_bytes}"
 
     @staticmethod
-    def depth_first_recurse(file, expected_total, files_processed, start_time):
-        file.fs_refresh()
-        # Nothing else to do if a file; recurse if dir.
-        if file.directory:
-            # Aggregate the bytes as we go for this directory's "size"
-            aggregated_bytes = 0
-            try:
-                with os.scandir(file.path) as iterator:
-                    for entry in iterator:
-                        # This is not a perfect check but collisions should be vanishingly rare.
-                        # We really want unique per path and *device id*, but device id is not returned
-                        # form os.scandir as a cached entry. However, on non-Windows, inode is documented
-                        # as being returned. It would be a strong coincidence that a file has both the
-                        # same path and inode on two different volumes; good enough for me.
-                        db_existing_entries = session.query(FileLikeObject).filter(FileLikeObject.path == entry.path).filter(FileLikeObject.inode == entry.inode()).limit(2).all()
-                        ASSERT(len(db_existing_entries) <= 1, "Got more than one entry with path {entry.path}")
-                        flo = None
-                        if len(db_existing_entries) == 1:
-                            flo = db_existing_entries[0]
-                        else:
-                            flo = FileLikeObject(path=entry.path)
-                        # Recurse, getting flo's stats and, if directory, its stat and childrens' stats.
-                        files_processed = FileLikeObject.depth_first_recurse(flo, expected_total, files_processed, start_time)
-                        # Now that we're on the upside of the recursion, every sub file or directory has its size.
-                        if flo.tree_size_bytes != None: # This can happen when e.g. a folder doesn't have permissions - it's effectively 0 bytes to us.
-                            aggregated_bytes += flo.tree_size_bytes
-                # OK, should have recursed amongst all children. Now "this" size should be accurate.
-                file.tree_size_bytes = aggregated_bytes
-            except PermissionError as p:
-                LOG.error(f"Did not have permission to descend into {file.path}")
-                return files_processed + 1
-        session.add(file)
+    def combine_subtree(children):
+        """
+        Merkle hash over (name, leaf) pairs for a directory's children; order-independent, and None if any leaf is.
+        """
+        digest = hashlib.sha256()
+        for name, leaf in sorted(children):
+            if leaf == None:
+                return None
+            digest.update(f"{name}\0{leaf}\n".encode("utf-8", "surrogateescape"))
+        return digest.hexdigest()
+
+    @staticmethod
+    def ancestors(session, flo_id):
+        """
+        flo_id and the ids above it, nearest first.
+        """
+        return [row.id for row in session.execute(text("""
+                WITH RECURSIVE chain(id, parent_id, depth) AS (
+                    SELECT id, parent_id, 0 FROM filelikes WHERE id = :id
+                    UNION ALL
+                    SELECT f.id, f.parent_id, chain.depth + 1 FROM filelikes f JOIN chain ON f.id = chain.parent_id
+                ) SELECT id FROM chain ORDER BY depth"""), {"id": flo_id})]
+
+    @staticmethod
+    def stored_subtree_fingerprint(session, flo_id):
+        """
+        combine_subtree over the directory's children as stored, taking the latest row for each name.
+        """
+        columns = [FileLikeObject.id, FileLikeObject.name, FileLikeObject.directory, FileLikeObject.permissions,
+                FileLikeObject.fingerprint, FileLikeObject.fingerprint_type, FileLikeObject.subtree_fingerprint,
+                FileLikeObject.tree_size_bytes]
+        children = {}
+        for row in session.execute(sqlalchemy.select(*columns).where(FileLikeObject.parent_id == flo_id).order_by(FileLikeObject.id)):
+            children[row.name] = FileLikeObject(**row._asdict()).merkle_leaf()
+        return FileLikeObject.combine_subtree(children.items())
+
+    @staticmethod
+    def refresh_subtree_fingerprints(session, directory_ids):
+        """
+        Recompute subtree_fingerprint from the stored children of directory_ids and of every directory above them,
+        deepest first so each sees its children's new fingerprints.
+        """
+        depths = {}         # directory id => depth below its root
+        for flo_id in directory_ids:
+            if flo_id == None or flo_id in depths:
+                continue
+            chain = FileLikeObject.ancestors(session, flo_id)
+            for (height, ancestor) in enumerate(chain):
+                depths[ancestor] = len(chain) - 1 - height
+        for flo_id in sorted(depths, key=lambda flo_id: -depths[flo_id]):
+            session.execute(sqlalchemy.update(FileLikeObject).where(FileLikeObject.id == flo_id).
+                    values(subtree_fingerprint=FileLikeObject.stored_subtree_fingerprint(session, flo_id)).
+                    execution_options(synchronize_session=False))
+
+    def place_under(self, parent_id):
+        """
+        Record where the walk found this entry: its parent's id and its name there.
+        """
+        self.parent_id = parent_id
+        self.name = os.path.basename(self.path) if parent_id != None else os.path.abspath(self.path)
+
+    @staticmethod
+    def on_host(host):
+        """
+        SQL criteria for rows scanned on host; rows from before hosts were recorded count as local.
+        Written so SQLite can't use the host index for it: next to a path or parent condition that index
+        is the far worse choice (most DBs hold a single host), but it looks like the better one to the planner.
+        """
+        return sqlalchemy.func.coalesce(FileLikeObject.host, host) == host
+
+    @staticmethod
+    def subtree_filter(root_path):
+        """
+        SQL criteria for the rows at or under root_path.
+        """
+        return sqlalchemy.or_(FileLikeObject.path == os.path.abspath(root_path), FileLikeObject.under_filter(root_path))
+
+    @staticmethod
+    def under_filter(directory, column="path"):
+        """
+        SQL criteria for the rows whose path (or another column holding full paths) is strictly under directory:
+        the half-open range from directory + sep up to (not including) directory with sep's successor, which
+        SQLite answers from an index on the column. A LIKE on the prefix can't use the index at all.
+        """
+        column = FileLikeObject.__table__.c[column]
+        prefix = os.path.abspath(directory).rstrip(os.sep) + os.sep
+        return (column >= prefix) & (column < prefix[:-1] + chr(ord(os.sep) + 1))
+
+    @staticmethod
+    def scan_recursively(file, incremental=False, bulk=False, batch_size=None, workers=None, use_processes=False,
+            defer_fingerprints=False, resume=False):
+        """
+        Call this function from the outside.
+        Streams a depth-first walk (see src.models.walker) into the DB and ensures commits when we're done.
+        A compact_paths DB (see src.models.paths) is always written in bulk.
+        With incremental, files whose stat matches the stored row are not re-fingerprinted.
+        With bulk, known rows are looked up a directory at a time and written in batches of batch_size
+        (see src.models.ingest); otherwise rows go through the session one by one.
+        With workers, content fingerprinting runs on a pool of that many threads (or processes) while
+        this thread keeps writing (see src.models.pipeline); this implies bulk.
+        With defer_fingerprints, files are not content hashed during the scan; run
+        src.models.dedupe.TieredDeduper afterwards to hash only the files that could be duplicates.
+        Every scan is recorded as a ScanSession, checkpointing each directory once its subtree is written.
+        With resume, an unfinished earlier scan of this root is picked up: its finished directories are
+        taken as they are without being walked again, and the rest is rescanned incrementally.
+        Returns the ScanProgress with counts of what was skipped and what was fingerprinted.
+        """
+        from src.models.ingest import OrmWriter, BulkWriter
+        from src.models.pipeline import ScanPipeline
+        from src.models.walker import walk, ScanConsumer
+        from src.models.paths import is_compact
+        from src.models.instrumentation import Instruments
+        scan, completed, resumed = ScanSession.start(session, file.path, resume)
+        if resumed:
+            # Whatever was written before the interruption needn't be fingerprinted again, finished directory or not.
+            incremental = True
+        instruments = Instruments()
+        compact = is_compact(session)
+        if bulk or workers or compact:
+            writer = BulkWriter(session, file.path, instruments=instruments, **({"batch_size": batch_size} if batch_size else {}))
+        else:
+            writer = OrmWriter(session, instruments=instruments, **({"batch_size": batch_size} if batch_size else {}))
+        # No separate counting pass: the estimate starts at what the last scan of this root went through
+        # (or, failing that, has stored), and grows as the walk discovers more than that.
+        previous_count = ScanSession.previous_total(session, file.path)
+        if previous_count == None and not compact:
+            previous_count = session.query(FileLikeObject).filter(FileLikeObject.subtree_filter(file.path)). \
+                    filter(FileLikeObject.on_host(writer.host)).count()
+        previous_count = previous_count or 0
+        LOG.info(f"Processing approximately {previous_count} files (from the last scan)")
+        # Rescanning a root we've seen before should update its row, not add a second one.
+        if file.id == None:
+            file = writer.existing_or_new(os.path.abspath(file.path), os.lstat(file.path).st_ino)
+        progress = ScanProgress(previous_count, incremental, defer_fingerprints, instruments)
+        progress.scan_id = scan.id
+        progress.completed = completed
+        if workers:
+            ScanPipeline(session, writer, progress, workers, use_processes).run(file)
+        else:
+            consumer = ScanConsumer(writer, progress)
+            for event in walk(file, writer.existing_or_new, progress):
+                if consumer.handle(event):
+                    consumer.fingerprinted(event[1], FileLikeObject.fingerprint_file(event[1].path, not defer_fingerprints))
+            # Since we might not have written the last set on a non-round batch size, do so now.
+            writer.finish()
+        ScanSession.finish(session, scan.id, progress)
+        LOG.info(f"Scan done: {progress.files_processed} entries, {progress.fingerprinted} fingerprinted, {progress.skipped} unchanged and skipped, " \
+                f"{progress.resumed} finished directories taken from the interrupted scan")
+        LOG.info(f"Scan phases: {json.dumps(progress.instruments.as_dict())}")
+        return progress
+
+
+class ScanProgress(object):
+    """
+    Counters threaded through a scan, so the caller can see what the scan actually did.
+    """
+    def __init__(self, previous_total, incremental=False, defer_fingerprints=False, instruments=None):
+        from src.models.instrumentation import Instruments
+        self.previous_total = previous_total    # Rows stored for this root by the last scan
+        self.discovered = 1                     # Entries the walk has listed so far, counting the root
+        self.incremental = incremental
+        self.defer_fingerprints = defer_fingerprints
+        self.start_time = datetime.datetime.now()
+        self.files_processed = 0
+        self.fingerprinted = 0      # Regular files that had mime/fingerprint/EXIF (re)computed
+        self.skipped = 0            # Regular files whose stored row matched lstat, so were left alone
+        self.resumed = 0            # Directories an interrupted scan had finished, so weren't walked again
+        self.scan_id = None         # The ScanSession to checkpoint finished directories against, if any
+        self.completed = set()      # Ids of the directories it had already finished
+        self.instruments = instruments if instruments != None else Instruments()   # Time per phase (lstat, magic, commit...)
+
+    @property
+    def expected_total(self):
+        return max(self.previous_total, self.discovered)
+
+    def entry_done(self):
+        files_processed = self.files_processed
         if files_processed > 0 and files_processed % 100 == 0:
-            time_delta = datetime.datetime.now() - start_time
-            seconds_per_file = float(time_delta.seconds) / files_processed
-            remaining = expected_total - files_processed
+            time_delta = datetime.datetime.now() - self.start_time
+            seconds_per_file = time_delta.total_seconds() / files_processed
+            remaining = self.expected_total - files_processed
             remaining_time = datetime.timedelta(seconds=remaining * seconds_per_file)
             end_time = datetime.datetime.now() + remaining_time
-            LOG.info(f"Files processed: {files_processed:7d} in {time_delta.seconds:5d} seconds, {seconds_per_file:.6f} seconds/file; projected end {end_time}")
-            session.commit()
-        return files_processed + 1
+            LOG.info(f"Files processed: {files_processed:7d} in {time_delta.seconds:5d} seconds, {seconds_per_file:.6f} seconds/file; projected end {end_time}; {self.instruments.summary()}")
+        self.files_processed += 1
 
 class ImageMetadata(Base):
 
@@ -197,18 +460,43 @@ class ImageMetadata(Base):
     gps_altitude_m = Column(Numeric)
     gps_datetime = Column(DateTime)
     gps_direction = Column(Numeric) #"M" is the most common suffix; this is "ref to magnetic north"
-
-    def populate_from_file(self):
-        img = Image.open(self.file.path)
+    # Perceptual hash (see src.models.similar): survives resizing and re-encoding, unlike the file's fingerprint.
+    # The bands are its four 16 bit quarters, indexed for near-duplicate lookups by multi-index hashing.
+    perceptual_hash = Column(String(16))
+    perceptual_band_0 = Column(Integer, index=True)
+    perceptual_band_1 = Column(Integer, index=True)
+    perceptual_band_2 = Column(Integer, index=True)
+    perceptual_band_3 = Column(Integer, index=True)
+
+    def column_values(self):
+        """
+        The EXIF-derived columns as a plain dict, e.g. to hand back from a worker process.
+        """
+        return {c.key: getattr(self, c.key) for c in ImageMetadata.__table__.columns if c.key not in ("id", "file_id")}
+
+    def populate_perceptual_hash(self, path=None):
+        from src.models.similar import perceptual_hash, to_hex, bands
+        if path == None:
+            path = self.file.path
+        value = perceptual_hash(path)
+        self.perceptual_hash = to_hex(value)
+        for (band, band_value) in enumerate(bands(value)):
+            setattr(self, f"perceptual_band_{band}", band_value)
+
+    def populate_from_file(self, path=None):
+        from PIL import Image, ExifTags
+        if path == None:
+            path = self.file.path
+        img = Image.open(path)
         exif = None
         try:
             exif = img._getexif()       # This is a private method; it may or may not be defined
         except AttributeError as e:
-            LOG.debug(f"{self.file.path} has no private _getexif method; trying public")
+            LOG.debug(f"{path} has no private _getexif method; trying public")
             exif = img.getexif()        # This is the more approved method
         
         if exif == None:
-            LOG.debug(f"{self.file.path} has no EXIF data")
+            LOG.debug(f"{path} has no EXIF data")
             return
 
         for (k, v) in exif.items():
@@ -232,11 +520,12 @@ class ImageMetadata(Base):
                 except ValueError as e:
                     LOG.error(f"Could not parse time value of {v}; skipping")
                     continue
-            LOG.trace(f"{tagname} => {v}")
+            if LOG.isEnabledFor(TRACE):
+                LOG.trace(f"{tagname} => {v}")
             if tagname == "GPSInfo": # Unpack the GPS subtags
-                for (l, w) in v.items():
-                    subtagname = ExifTags.GPSTAGS[l]
-                    LOG.trace(f"  {subtagname} => {w}")
+                if LOG.isEnabledFor(TRACE):
+                    for (l, w) in v.items():
+                        LOG.trace(f"  {ExifTags.GPSTAGS[l]} => {w}")
                 # Assume the standard set of tags are always here if any gps tags are.
                 try:
                     lat_t = v[ExifTags.GPS.GPSLatitude]
@@ -267,13 +556,196 @@ class ImageMetadata(Base):
 
 
 
+class DatabaseSetting(Base):
+    """
+    Per-database key/value settings, e.g. whether paths are stored compactly.
+    """
+    __tablename__ = "settings"
+    key = Column(String(256), primary_key=True)
+    value = Column(String(4096))
+
+    @staticmethod
+    def get(session, key):
+        setting = session.get(DatabaseSetting, key)
+        return setting.value if setting != None else None
+
+    @staticmethod
+    def put(session, key, value):
+        session.merge(DatabaseSetting(key=key, value=value))
+        session.commit()
+
+    HOST_SETTING = "host"
+
+    @staticmethod
+    def host(session):
+        """
+        What scans into this DB record as their host: the "host" setting, or else this machine's hostname.
+        Shards meant to be merged (see src.models.merge) need distinct hosts.
+        """
+        host = DatabaseSetting.get(session, DatabaseSetting.HOST_SETTING)
+        return host if host != None else socket.gethostname()
+
+
+class ScanSession(Base):
+    """
+    One scan_recursively of a root, so that a scan that was killed can be resumed: its counters as of the
+    last checkpoint, and (in scan_checkpoints) every directory whose whole subtree it has written.
+    """
+    __tablename__ = "scan_sessions"
+    id = Column(Integer, primary_key=True)
+    root_path = Column(String(4096), index=True)
+    started = Column(DateTime)
+    last_checkpoint = Column(DateTime)
+    finished = Column(DateTime)                 # NULL while running, or if it never got to finish
+    resumes = Column(Integer, default=0)
+    files_processed = Column(Integer, default=0)
+    fingerprinted = Column(Integer, default=0)
+    skipped = Column(Integer, default=0)
+
+    @staticmethod
+    def start(session, root_path, resume=False):
+        """
+        (session, ids of the directories it has already finished, whether it's being resumed) for a scan of
+        root_path: with resume, the latest session for root_path if it never finished, otherwise a new session.
+        A new session supersedes any unfinished ones before it, whose checkpoints are dropped: once a later
+        scan has been through, what they finished may have changed since.
+        """
+        root_path = os.path.abspath(root_path)
+        scan = None
+        if resume:
+            latest = session.query(ScanSession).filter(ScanSession.root_path == root_path).order_by(ScanSession.id.desc()).first()
+            if latest != None and latest.finished == None:
+                scan = latest
+        if scan == None:
+            unfinished = sqlalchemy.select(ScanSession.id).where(ScanSession.root_path == root_path).where(ScanSession.finished == None)
+            session.execute(sqlalchemy.delete(ScanCheckpoint).where(ScanCheckpoint.scan_id.in_(unfinished)))
+            scan = ScanSession(root_path=root_path, started=datetime.datetime.now())
+            session.add(scan)
+            session.commit()
+            return (scan, set(), False)
+        scan.resumes += 1
+        session.commit()
+        completed = {directory_id for (directory_id,) in session.execute(
+            sqlalchemy.select(ScanCheckpoint.directory_id).where(ScanCheckpoint.scan_id == scan.id))}
+        LOG.info(f"Resuming the scan of {root_path} started {scan.started}: {len(completed)} directories already done")
+        return (scan, completed, True)
+
+    @staticmethod
+    def previous_total(session, root_path):
+        """
+        How many entries the last scan of root_path to finish went through, or None if none has.
+        """
+        return session.execute(sqlalchemy.select(ScanSession.files_processed).
+                where(ScanSession.root_path == os.path.abspath(root_path)).where(ScanSession.finished != None).
+                order_by(ScanSession.id.desc()).limit(1)).scalar()
+
+    @staticmethod
+    def progress_update(scan_id, progress):
+        return sqlalchemy.update(ScanSession).where(ScanSession.id == scan_id).values(
+                last_checkpoint=datetime.datetime.now(), files_processed=progress.files_processed,
+                fingerprinted=progress.fingerprinted, skipped=progress.skipped)
+
+    @staticmethod
+    def finish(session, scan_id, progress):
+        """
+        Mark the scan done; its checkpoints aren't needed any more.
+        """
+        session.execute(ScanSession.progress_update(scan_id, progress).values(finished=datetime.datetime.now()))
+        session.execute(sqlalchemy.delete(ScanCheckpoint).where(ScanCheckpoint.scan_id == scan_id))
+        session.commit()
+
+
+class ScanCheckpoint(Base):
+    """
+    A directory that a scan has written along with everything under it (sizes and subtree fingerprint included).
+    Written in the same transaction as the directory's own row.
+    """
+    __tablename__ = "scan_checkpoints"
+    scan_id = Column(Integer, ForeignKey("scan_sessions.id"), primary_key=True)
+    directory_id = Column(Integer, ForeignKey("filelikes.id"), primary_key=True)
+
+
+class DuplicateGroup(Base):
+    """
+    One row per distinct (fingerprint, tree_size_bytes) among fingerprinted regular files, kept up to date by
+    triggers on filelikes, so duplicate questions never need a GROUP BY over the whole table.
+    Groups with member_count > 1 are the duplicates.
+    """
+    __tablename__ = "duplicate_groups"
+    __table_args__ = (
+            # Keyset pages of src.models.reports.DuplicateFilesReport are ranges on this.
+            sqlalchemy.Index("ix_duplicate_groups_wasted_bytes_fingerprint_tree_size_bytes", "wasted_bytes", "fingerprint", "tree_size_bytes",
+                    sqlite_where=text("member_count > 1")),
+            )
+    fingerprint = Column(String(1024), primary_key=True)
+    tree_size_bytes = Column(BigInteger, primary_key=True)
+    member_count = Column(Integer, nullable=False)
+    wasted_bytes = Column(BigInteger, index=True, nullable=False)   # Bytes freed by keeping only one member
+
+    # Which filelikes rows count towards a group, as SQL over a row alias (NEW, OLD, or a table).
+    @staticmethod
+    def member_condition(row):
+        return f"{row}.fingerprint IS NOT NULL AND {row}.tree_size_bytes IS NOT NULL AND NOT COALESCE({row}.directory, 0) " \
+                f"AND ({row}.fingerprint_type IS NULL OR {row}.fingerprint_type != 'error')"
+
+    @staticmethod
+    def trigger_statements():
+        join = lambda row: f"fingerprint = {row}.fingerprint AND tree_size_bytes = {row}.tree_size_bytes"
+        add = lambda row: f"""INSERT INTO duplicate_groups (fingerprint, tree_size_bytes, member_count, wasted_bytes)
+                SELECT {row}.fingerprint, {row}.tree_size_bytes, 1, 0 WHERE {DuplicateGroup.member_condition(row)}
+                ON CONFLICT (fingerprint, tree_size_bytes) DO UPDATE SET member_count = member_count + 1, wasted_bytes = tree_size_bytes * member_count;"""
+        # SQLite evaluates every SET expression against the old values, so member_count - 2 is (new count - 1).
+        remove = lambda row: f"""UPDATE duplicate_groups SET member_count = member_count - 1, wasted_bytes = MAX(tree_size_bytes * (member_count - 2), 0)
+                WHERE {join(row)} AND {DuplicateGroup.member_condition(row)};
+            DELETE FROM duplicate_groups WHERE {join(row)} AND member_count <= 0;"""
+        changed = " OR ".join(f"OLD.{c} IS NOT NEW.{c}" for c in ("fingerprint", "fingerprint_type", "tree_size_bytes", "directory"))
+        return [
+            f"""CREATE TRIGGER IF NOT EXISTS duplicate_groups_insert AFTER INSERT ON filelikes BEGIN {add("NEW")} END""",
+            f"""CREATE TRIGGER IF NOT EXISTS duplicate_groups_delete AFTER DELETE ON filelikes BEGIN {remove("OLD")} END""",
+            f"""CREATE TRIGGER IF NOT EXISTS duplicate_groups_update AFTER UPDATE OF fingerprint, fingerprint_type, tree_size_bytes, directory ON filelikes
+                WHEN {changed} BEGIN {remove("OLD")} {add("NEW")} END""",
+            ]
+
+    @staticmethod
+    def create_triggers(connection):
+        """
+        Install the maintenance triggers, filling the table from scratch the first time around.
+        """
+        installed = connection.execute(text("""SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'duplicate_groups_%'""")).scalar()
+        for statement in DuplicateGroup.trigger_statements():
+            connection.execute(text(statement))
+        if installed < len(DuplicateGroup.trigger_statements()):
+            DuplicateGroup.rebuild(connection)
+
+    @staticmethod
+    def rebuild(connection):
+        """
+        Recompute every group with one GROUP BY, e.g. after bulk changes made with the triggers absent.
+        """
+        connection.execute(text("""DELETE FROM duplicate_groups"""))
+        connection.execute(text(f"""INSERT INTO duplicate_groups (fingerprint, tree_size_bytes, member_count, wasted_bytes)
+                SELECT fingerprint, tree_size_bytes, COUNT(*), tree_size_bytes * (COUNT(*) - 1) FROM filelikes
+                WHERE {DuplicateGroup.member_condition("filelikes")} GROUP BY fingerprint, tree_size_bytes"""))
+
+    @staticmethod
+    def top_by_wasted_bytes(limit=100):
+        """
+        The duplicate groups it would pay most to clean up, straight off the wasted_bytes index.
+        """
+        return session.query(DuplicateGroup).filter(DuplicateGroup.member_count > 1). \
+                order_by(DuplicateGroup.wasted_bytes.desc()).limit(limit).all()
+
+
 class DuplicateView(Base):
     __tablename__ = "view_duplicates"
     __table_args__ = {'info': dict(is_view=True)}
 
     # A subset of the stuff in the main table
     id = Column(Integer, primary_key=True)
-    path = Column(String(4096), index=True, nullable=False)     # The filename; max size is from extfs
+    path = Column(String(4096), index=True)                     # The full path; NULL in a compact_paths DB
+    parent_id = Column(Integer)
+    name = Column(String(4096))
+    host = Column(String(255))
     fingerprint = Column(String(1024), index=True)              # The fingerprint of the file. Generally some hash, can be filetype-dependent.
     mime = Column(String(1024), index=True)                     # MIME type from Python Magic library
     tree_size_bytes = Column(BigInteger, index=True)            # The size of the whole subtree (for files, size of self)
@@ -286,86 +758,164 @@ class DuplicateView(Base):
         # But, we want a view and just want to ORM on top of it!
         # So if the name view_duplicates exists as a table, drop it.
         # If the name view_duplicates does not exist as a view, create it.
-        inspector = sqlalchemy.inspect(connection.engine)
+        inspector = sqlalchemy.inspect(connection)
         if 'view_duplicates' in inspector.get_table_names():
             statement = text("""DROP TABLE view_duplicates""")
             connection.execute(statement)
-        if 'view_duplicates' not in inspector.get_view_names():
-            statement = text("""CREATE VIEW view_duplicates AS SELECT a.id, a.path, a.fingerprint, a.mime, a.tree_size_bytes, a.dev_number, a.creation_or_meta FROM filelikes a JOIN (SELECT path, fingerprint, COUNT(*) FROM filelikes GROUP BY fingerprint HAVING COUNT(*) > 1 ) b ON a.fingerprint = b.fingerprint ORDER BY a.fingerprint DESC""")
-            connection.execute(statement)
+        # Older DBs have the view defined over a GROUP BY of filelikes; swap it for the one over duplicate_groups.
+        existing = connection.execute(text("""SELECT sql FROM sqlite_master WHERE type = 'view' AND name = 'view_duplicates'""")).scalar()
+        if existing != None and existing != DuplicateView.VIEW_SQL:
+            connection.execute(text("""DROP VIEW view_duplicates"""))
+            existing = None
+        if existing == None:
+            connection.execute(text(DuplicateView.VIEW_SQL))
+
+    # Same columns as ever, but only from groups duplicate_groups already knows have more than one member,
+    # which leaves out directories and "error" fingerprints.
+    VIEW_SQL = """CREATE VIEW view_duplicates AS SELECT a.id, a.path, a.parent_id, a.name, a.host, a.fingerprint, a.mime, a.tree_size_bytes, a.dev_number, a.creation_or_meta FROM duplicate_groups g JOIN filelikes a ON a.fingerprint = g.fingerprint AND a.tree_size_bytes = g.tree_size_bytes WHERE g.member_count > 1 AND NOT COALESCE(a.directory, 0) AND (a.fingerprint_type IS NULL OR a.fingerprint_type != 'error') ORDER BY a.fingerprint DESC"""
 
+    @staticmethod
+    def identical_folders():
+        """
+        Yields (subtree_fingerprint, tree_size_bytes, [paths]) for every set of directories whose whole
+        trees are identical, biggest first. One GROUP BY over the subtree_fingerprint index; empty trees are left out.
+        Note that the identical subdirectories of identical directories are listed too.
+        """
+        from src.models.paths import PathResolver
+        resolver = PathResolver(session)
+        groups = session.execute(
+                sqlalchemy.select(FileLikeObject.subtree_fingerprint, FileLikeObject.tree_size_bytes).
+                where(FileLikeObject.directory == True).
+                where(FileLikeObject.subtree_fingerprint != None).
+                where(FileLikeObject.tree_size_bytes > 0).
+                group_by(FileLikeObject.subtree_fingerprint).
+                having(sqlalchemy.func.count() > 1).
+                order_by(FileLikeObject.tree_size_bytes.desc())).all()
+        for subtree_fingerprint, tree_size_bytes in groups:
+            rows = session.execute(
+                    sqlalchemy.select(FileLikeObject.path, FileLikeObject.parent_id, FileLikeObject.name, FileLikeObject.host).
+                    where(FileLikeObject.subtree_fingerprint == subtree_fingerprint)).all()
+            yield (subtree_fingerprint, tree_size_bytes, sorted(resolver.located(row, resolver.full_path(row)) for row in rows))
 
     @staticmethod
     def scan_for_duplicate_folders():
-        # Map of directory to
-        #   Map of directory to array of ids of matches
-        #
-        # This is a bidirectional map; i.e. there will be an A => B and a B => A pairing (because we don't yet know the set we draw bidirectional edges to cover all keys)
-        folders = {}
-        def bidirectional_duplicates(value, last_value):
-            last_dir = str(pathlib.Path(last_value.path).parent)
-            current_dir = str(pathlib.Path(value.path).parent)
-            
-            def map_a_b(a, b):
-                if folders.get(a) == None:
-                    folders[a] = {}
-                if folders.get(a).get(b) == None:
-                    folders[a][b] = 0
-                folders[a][b] += 1
-            map_a_b(current_dir, last_dir)
-            map_a_b(last_dir, current_dir)
-
-        dupes = session.query(DuplicateView).all()
-        last_value = None
-        for value in dupes:
-            # First loop through we don't care; we need two (in order to get the first directory name)
-            if last_value != None and value.fingerprint == last_value.fingerprint:
-                bidirectional_duplicates(value, last_value)
-            last_value = value
-        # Now create tuples from the hashes
-        tuples = set()
-        for key, innerdict in folders.items():
-            for innerkey, count in innerdict.items():
-                # Dedupe with alphabetical sort
-                smaller_key = min(key, innerkey)
-                larger_key = max(key, innerkey)
-                if smaller_key == larger_key:
-                    continue
-                tup = (smaller_key, larger_key, count)
-                tuples.add(tup)
+        """
+        Partial overlap between folders: how many duplicate files each pair of folders has in common.
+        Streams the view in fingerprint order so only one group of duplicates is in memory at a time;
+        every pair of folders in a group is counted, however many copies there are.
+        Returns a list of (dir, dir, count_overlaps) tuples, most overlapping first.
+        """
+        from src.models.paths import PathResolver
+        resolver = PathResolver(session)
+        # Map of (smaller dir, larger dir) => number of fingerprints they share
+        overlaps = {}
+        def count_group(dirs):
+            # Dedupe with alphabetical sort
+            for pair in itertools.combinations(sorted(dirs), 2):
+                overlaps[pair] = overlaps.get(pair, 0) + 1
+
+        rows = session.execute(
+                sqlalchemy.select(DuplicateView.fingerprint, DuplicateView.path, DuplicateView.parent_id, DuplicateView.name, DuplicateView.host).
+                order_by(DuplicateView.fingerprint).
+                execution_options(yield_per=1000))
+        last_fingerprint = None
+        dirs = set()
+        for row in rows:
+            if row.fingerprint != last_fingerprint:
+                count_group(dirs)
+                dirs = set()
+                last_fingerprint = row.fingerprint
+            dirs.add(resolver.located(row, resolver.directory_of(row)))
+        count_group(dirs)
         # Return sorted list of (dir, dir, count_overlaps) tuples by number of overlapping files
-        return sorted(list(tuples), key=lambda t: -t[2])
+        return sorted(((a, b, count) for ((a, b), count) in overlaps.items()), key=lambda t: -t[2])
 
 
-session = None
+DEFAULT_DB_FILENAME = "file_metadata.sqlite"
 
-in_memory_session = None
-def bind_in_memory_db():
-    in_memory_engine = create_engine('sqlite://')
-    print("Creating in-memory DB")
-    Base.metadata.create_all(in_memory_engine)
+session = None     # Set by whoever opens the DB; see bind_file_db
 
-    Base.metadata.bind = in_memory_engine
-    DBSession = sessionmaker(bind=in_memory_engine)
+def upgrade_schema(engine):
+    """
+    create_all only creates missing tables. Add any columns (and indexes) that a model has gained
+    since the DB was created; new columns are all nullable, so old rows just read as NULL.
+    Rows from before parent_id and name were recorded get them filled in, since scans find stored rows through them.
+    """
+    from src.models.paths import link_parents
+    inspector = sqlalchemy.inspect(engine)
+    table_names = inspector.get_table_names()
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.info.get("is_view") or table.name not in table_names:
+                continue
+            existing = set(c["name"] for c in inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name not in existing:
+                    LOG.info(f"Adding column {table.name}.{column.name}")
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+            if table.name == FileLikeObject.__tablename__ and "name" not in existing:
+                link_parents(conn)
+
+def schema_stamp(engine):
+    """
+    A checksum of everything prepare_schema sets up, kept in SQLite's user_version so that opening a
+    DB that's already current costs one PRAGMA rather than a round of inspection and DDL.
+    """
+    from sqlalchemy.schema import CreateTable, CreateIndex
+    statements = []
+    for table in Base.metadata.sorted_tables:
+        statements.append(str(CreateTable(table).compile(engine)))
+        statements.extend(str(CreateIndex(index).compile(engine)) for index in sorted(table.indexes, key=lambda index: index.name))
+    statements.extend(DuplicateGroup.trigger_statements())
+    statements.append(DuplicateView.VIEW_SQL)
+    return zlib.crc32("\n".join(statements).encode("utf-8")) & 0x7fffffff or 1
+
+def prepare_schema(engine):
+    """
+    Create, upgrade and install the triggers and view of the DB behind engine, unless it's already current.
+    """
+    stamp = schema_stamp(engine)
+    with engine.connect() as conn:
+        if conn.execute(text("PRAGMA user_version")).scalar() == stamp:
+            return
+    Base.metadata.create_all(engine)
+    upgrade_schema(engine)
+    with engine.begin() as conn:
+        DuplicateGroup.create_triggers(conn)
+        DuplicateView.create_view(conn)
+        conn.execute(text(f"PRAGMA user_version = {stamp}"))
 
-    in_memory_session = DBSession()
-    return in_memory_session
+def clear_schema_stamp(connection):
+    """
+    For anything that takes the schema apart for a while (see src.models.merge): if it doesn't get to
+    put it back, the next open will.
+    """
+    connection.execute(text("PRAGMA user_version = 0"))
 
-file_session = None
-def bind_file_db():
+def default_db_path():
+    return os.environ.get("FS_BUDDY_DB", DEFAULT_DB_FILENAME)
 
-    sqlite_db_filename = "file_metadata.sqlite"
+def bind_in_memory_db():
+    in_memory_engine = create_engine('sqlite://')
+    LOG.info("Creating in-memory DB")
+    prepare_schema(in_memory_engine)
+    DBSession = sessionmaker(bind=in_memory_engine)
+    return DBSession()
+
+def bind_file_db(sqlite_db_filename=None):
+    """
+    Open (creating or upgrading as needed) the DB at sqlite_db_filename, by default $FS_BUDDY_DB or
+    file_metadata.sqlite in the current directory.
+
+    Nothing opens a DB on import: whoever needs one calls this (or bind_in_memory_db) and sets
+    src.models.file.session, which the scan and duplicate code works through.
+    """
+    if sqlite_db_filename == None:
+        sqlite_db_filename = default_db_path()
     file_engine = create_engine(f'sqlite:///{sqlite_db_filename}')
-    print(f"Creating filesystem DB at {sqlite_db_filename}")
-
-    Base.metadata.create_all(file_engine)
-    Base.metadata.bind = file_engine
+    LOG.info(f"Opening filesystem DB at {sqlite_db_filename}")
+    prepare_schema(file_engine)
     DBSession = sessionmaker(bind=file_engine)
-
-    with file_engine.connect() as conn:
-        DuplicateView.create_view(conn)
-
-    file_session = DBSession()
-    return file_session
-
-session = bind_file_db() # For now it doesn't seem to help perf by worrying about in-memory or in file.
+    return DBSession()
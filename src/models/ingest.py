@@ -0,0 +1,263 @@
+import os
+import time
+from sqlalchemy import select, insert, update, func
+
+from src.models.file import FileLikeObject, ImageMetadata, ScanSession, ScanCheckpoint, DatabaseSetting
+from src.models.instrumentation import Instruments
+
+import logging
+import python_logging_base
+from python_logging_base import ASSERT, TODO
+
+LOG = logging.getLogger("ingest")
+
+
+class OrmWriter(object):
+    """
+    The original ingestion path: one SELECT per entry to find an existing row, session.add per row,
+    and a commit every batch_size rows.
+    """
+    def __init__(self, session, batch_size=100, instruments=None):
+        self.session = session
+        self.batch_size = batch_size
+        self.instruments = instruments if instruments != None else Instruments()
+        self.checkpoints = PendingCheckpoints()
+        self.host = DatabaseSetting.host(session)
+        self.added = 0
+
+    def existing_or_new(self, path, inode, parent=None):
+        # The parent was added on entering it, so the autoflush in this query has given it an id.
+        flo = FileLikeObject.existing_or_new(path, inode, self.host)
+        place(flo, parent, self.host)
+        return flo
+
+    def add(self, flo):
+        self.session.add(flo)
+        self.added += 1
+        if self.added % self.batch_size == 0:
+            self.commit()
+
+    def checkpoint(self, scan_id, directory, progress):
+        self.checkpoints.add(scan_id, directory, progress)
+
+    def finish(self):
+        self.commit()
+
+    def commit(self):
+        start = time.perf_counter()
+        if self.checkpoints.pending():
+            # Give new directories their ids before recording them.
+            self.session.flush()
+            self.checkpoints.write(self.session)
+        self.session.commit()
+        self.instruments.record("commit", time.perf_counter() - start)
+
+
+def place(flo, parent, host):
+    """
+    Link flo to the directory the walk found it in, on host. A scan root keeps any parent it was already stored with.
+    """
+    flo.host = host
+    if parent != None:
+        flo.place_under(parent.id)
+    elif flo.parent_id == None:
+        flo.place_under(None)
+
+
+class PendingCheckpoints(object):
+    """
+    Finished directories (see ScanCheckpoint) waiting for the writer's next commit, so they're recorded
+    in the same transaction as the rows they vouch for, and the scan's counters as of the latest one.
+    """
+    def __init__(self):
+        self.directories = []
+        self.scan_id = None
+        self.progress = None
+
+    def add(self, scan_id, directory, progress):
+        self.scan_id = scan_id
+        self.progress = progress
+        self.directories.append(directory)
+
+    def pending(self):
+        return len(self.directories) > 0
+
+    def write(self, session):
+        session.execute(insert(ScanCheckpoint.__table__),
+                [{"scan_id": self.scan_id, "directory_id": directory.id} for directory in self.directories])
+        session.execute(ScanSession.progress_update(self.scan_id, self.progress))
+        self.directories = []
+
+
+class BulkWriter(object):
+    """
+    Bulk ingestion path.
+
+    Stored rows are looked up a directory at a time: the first time the walk asks about an entry of a
+    directory, all of that directory's stored children are loaded with one range scan on
+    ix_filelikes_parent_id_name (nothing at all for directories new in this scan). The walk is depth first,
+    so only the listings of the directories it's in the middle of are kept, and memory stays proportional
+    to depth times directory size rather than to the size of the tree.
+    Rows handed back to the walk are transient (never attached to the session); new and changed rows are
+    written with one executemany INSERT / UPDATE per batch_size rows.
+
+    New rows get their ids here, up front, so children can point at a parent that hasn't been
+    written yet; that's safe because this is the only writer.
+    In a compact_paths DB the path column is never written.
+    With commits False, batches are written but not committed, leaving the transaction to the caller
+    (see src.models.watch).
+    """
+    def __init__(self, session, root_path, batch_size=1000, instruments=None, commits=True):
+        from src.models.paths import is_compact
+        self.session = session
+        self.commits = commits
+        self.batch_size = batch_size
+        self.instruments = instruments if instruments != None else Instruments()
+        self.checkpoints = PendingCheckpoints()
+        self.host = DatabaseSetting.host(session)
+        self.compact = is_compact(session)
+        self.known = {}         # (path, inode) => stored row, for the roots and the directories being walked
+        self.listings = {}      # directory id => (parent id, keys of known loaded for it), see load_children
+        self.inserts = []       # Transient FileLikeObjects not in the DB yet
+        self.updates = []       # Transient FileLikeObjects standing in for a stored row
+        self.fresh = set()      # Ids handed out here and not yet queued for insert
+        self.next_id = (session.execute(select(func.max(FileLikeObject.id))).scalar() or 0) + 1
+        self.first_new_id = self.next_id
+        self.children_of = self.stored_children
+        start = time.perf_counter()
+        self.load_roots(root_path)
+        self.instruments.record("load_index", time.perf_counter() - start)
+
+    def load_roots(self, root_path):
+        """
+        The scan root's own stored row, and the root rows of any earlier, narrower scans under it.
+        """
+        from src.models.paths import PathResolver
+        root_path = os.path.abspath(root_path)
+        table = FileLikeObject.__table__
+        if self.compact:
+            root = table.c.id == PathResolver(self.session).lookup_id(root_path, self.host)
+        else:
+            root = table.c.path == root_path
+        rows = self.session.execute(select(table).where(root).where(FileLikeObject.on_host(self.host)).order_by(table.c.id)).mappings()
+        for row in rows:
+            self.remember(dict(row, path=root_path))
+        rows = self.session.execute(select(table).where(table.c.parent_id == None).where(FileLikeObject.under_filter(root_path, "name")).
+                where(FileLikeObject.on_host(self.host)).order_by(table.c.id)).mappings()
+        for row in rows:
+            self.remember(dict(row, path=row["name"]))
+
+    def remember(self, row):
+        key = (row["path"], row["inode"])
+        self.known[key] = row
+        return key
+
+    def load_children(self, directory):
+        """
+        Load directory's stored children, first forgetting the listings of directories the walk has finished
+        with: being depth first, that's every one that isn't directory or above it.
+        """
+        start = time.perf_counter()
+        above = set()
+        ancestor = directory.parent_id
+        while ancestor in self.listings and ancestor not in above:
+            above.add(ancestor)
+            ancestor = self.listings[ancestor][0]
+        for finished in [directory_id for directory_id in self.listings if directory_id not in above]:
+            for key in self.listings.pop(finished)[1]:
+                self.known.pop(key, None)
+        keys = []
+        if directory.id < self.first_new_id:
+            keys = [self.remember(dict(row, path=os.path.join(directory.path, row["name"]))) for row in self.children_of(directory.id)]
+        self.listings[directory.id] = (directory.parent_id, keys)
+        self.instruments.record("load_children", time.perf_counter() - start)
+
+    def stored_children(self, directory_id):
+        """
+        The stored rows with directory_id as their parent, oldest first. Uses the session, so it has to run on
+        the session's thread; a walk on another thread sets children_of to something that gets it run there.
+        """
+        table = FileLikeObject.__table__
+        return self.session.execute(select(table).where(table.c.parent_id == directory_id).order_by(table.c.id)).mappings().all()
+
+    def existing_or_new(self, path, inode, parent=None):
+        if parent != None and parent.id not in self.listings:
+            self.load_children(parent)
+        row = self.known.pop((path, inode), None)
+        if row == None:
+            flo = FileLikeObject(path=path, id=self.next_id)
+            self.fresh.add(self.next_id)
+            self.next_id += 1
+        else:
+            flo = FileLikeObject(**row)
+        place(flo, parent, self.host)
+        return flo
+
+    def add(self, flo):
+        if flo.id in self.fresh:
+            self.fresh.remove(flo.id)
+            self.inserts.append(flo)
+        else:
+            self.updates.append(flo)
+        if len(self.inserts) + len(self.updates) >= self.batch_size:
+            self.flush()
+
+    def checkpoint(self, scan_id, directory, progress):
+        self.checkpoints.add(scan_id, directory, progress)
+
+    def flush(self):
+        start = time.perf_counter()
+        table = FileLikeObject.__table__
+        metas = []
+        if len(self.inserts) > 0:
+            self.session.execute(insert(table), [self.column_values(flo, table) for flo in self.inserts])
+            metas.extend(flo for flo in self.inserts if flo.image_meta != None)
+        if len(self.updates) > 0:
+            self.session.execute(update(FileLikeObject), [self.column_values(flo, table) for flo in self.updates])
+            refreshed = [flo for flo in self.updates if flo.image_meta != None]
+            if len(refreshed) > 0:
+                # Same as the ORM replacing the one-to-one: the old metadata row is orphaned, not deleted.
+                meta_table = ImageMetadata.__table__
+                self.session.execute(update(meta_table).where(meta_table.c.file_id.in_([flo.id for flo in refreshed])).values(file_id=None))
+            metas.extend(refreshed)
+        if len(metas) > 0:
+            meta_table = ImageMetadata.__table__
+            meta_rows = []
+            for flo in metas:
+                values = BulkWriter.defaulted_values(flo.image_meta, meta_table)
+                values["file_id"] = flo.id
+                meta_rows.append(values)
+            self.session.execute(insert(meta_table), meta_rows)
+        if self.checkpoints.pending():
+            self.checkpoints.write(self.session)
+        written = time.perf_counter()
+        self.instruments.record("write", written - start)
+        if self.commits:
+            self.session.commit()
+            self.instruments.record("commit", time.perf_counter() - written)
+        self.inserts = []
+        self.updates = []
+
+    def finish(self):
+        self.flush()
+
+    def column_values(self, flo, table):
+        values = BulkWriter.defaulted_values(flo, table)
+        if self.compact:
+            values["path"] = None
+        return values
+
+    @staticmethod
+    def defaulted_values(obj, table):
+        """
+        Column values for an executemany, filled in the way the ORM would on flush.
+        """
+        values = {}
+        for column in table.columns:
+            value = getattr(obj, column.key)
+            if value == None and column.primary_key:
+                continue
+            if value == None and column.default != None and column.default.is_scalar:
+                value = column.default.arg
+            values[column.key] = value
+        return values
@@ -0,0 +1,91 @@
+import threading
+
+import logging
+import python_logging_base
+from python_logging_base import ASSERT, TODO
+
+LOG = logging.getLogger("instrumentation")
+
+
+class PhaseStats(object):
+    """
+    Cumulative numbers for one phase of a scan (e.g. "lstat" or "imohash").
+    Latencies go into power-of-two microsecond buckets: bucket n counts calls that took less than 2**n us.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.bytes_read = 0
+        self.buckets = []
+
+    def record(self, seconds, bytes_read=0):
+        self.calls += 1
+        self.seconds += seconds
+        self.bytes_read += bytes_read
+        bucket = int(seconds * 1000000).bit_length()
+        if bucket >= len(self.buckets):
+            self.buckets.extend([0] * (bucket + 1 - len(self.buckets)))
+        self.buckets[bucket] += 1
+
+    def percentile_us(self, fraction):
+        """
+        Upper bound of the bucket holding the given fraction of calls.
+        """
+        wanted = fraction * self.calls
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= wanted and count > 0:
+                return 1 << bucket
+        return None
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "seconds": self.seconds,
+            "bytes_read": self.bytes_read,
+            "mean_us": self.seconds * 1000000 / self.calls if self.calls > 0 else None,
+            "p50_us": self.percentile_us(0.5),
+            "p99_us": self.percentile_us(0.99),
+            "histogram_us": {f"<{1 << bucket}": count for (bucket, count) in enumerate(self.buckets) if count > 0},
+        }
+
+
+class Instruments(object):
+    """
+    Per-phase timings for a scan. The walker thread and the consumer both record, so record() takes a lock;
+    fingerprint_file runs on workers (maybe in other processes) and hands its timings back in its result
+    instead, for record_all() on the consumer.
+
+    Callers time with time.perf_counter() themselves and record the difference, rather than going through a
+    context manager per call.
+    """
+    def __init__(self):
+        self.phases = {}        # name => PhaseStats
+        self.lock = threading.Lock()
+
+    def record(self, phase, seconds, bytes_read=0):
+        with self.lock:
+            stats = self.phases.get(phase)
+            if stats == None:
+                stats = self.phases[phase] = PhaseStats()
+            stats.record(seconds, bytes_read)
+
+    def record_all(self, timings):
+        """
+        Record a list of (phase, seconds, bytes_read), as returned by FileLikeObject.fingerprint_file.
+        """
+        for (phase, seconds, bytes_read) in timings:
+            self.record(phase, seconds, bytes_read)
+
+    def summary(self, top=4):
+        """
+        The phases that took longest so far, for the progress line.
+        """
+        with self.lock:
+            phases = sorted(self.phases.items(), key=lambda item: -item[1].seconds)[:top]
+            return ", ".join(f"{name} {stats.seconds:.2f}s/{stats.calls}" for (name, stats) in phases)
+
+    def as_dict(self):
+        with self.lock:
+            return {name: stats.as_dict() for (name, stats) in sorted(self.phases.items())}
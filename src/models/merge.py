@@ -0,0 +1,110 @@
+import os
+
+from sqlalchemy.sql import text
+
+from src.models.file import FileLikeObject, ImageMetadata, DatabaseSetting, DuplicateGroup, DuplicateView, clear_schema_stamp
+from src.models.paths import COMPACT_PATHS_SETTING
+
+import logging
+import python_logging_base
+from python_logging_base import ASSERT, TODO
+
+LOG = logging.getLogger("merge")
+
+
+def columns_of(connection, schema, table):
+    return [row[1] for row in connection.execute(text(f"PRAGMA {schema}.table_info({table})"))]
+
+
+def shard_roots(connection, default_host):
+    """
+    (host, absolute path) of each scan root the shard holds: the rows without a parent.
+    """
+    return connection.execute(text(
+            "SELECT DISTINCT COALESCE(host, :default_host), name FROM shard.filelikes WHERE parent_id IS NULL"),
+            {"default_host": default_host}).all()
+
+
+def shard_default_host(connection, path):
+    """
+    The host to give shard rows that don't record one: the shard's host setting, else its file name.
+    """
+    if "settings" in [name for (name,) in connection.execute(text("SELECT name FROM shard.sqlite_master WHERE type = 'table'"))]:
+        host = connection.execute(text("SELECT value FROM shard.settings WHERE key = :key"), {"key": DatabaseSetting.HOST_SETTING}).scalar()
+        if host != None:
+            return host
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def merge_shards(engine, shard_paths):
+    """
+    Bulk import shard DBs (each scanned on its own host) into the DB behind engine, entirely in SQL:
+    each shard is ATTACHed and copied with one INSERT ... SELECT per table, its ids offset past the
+    rows already here so parent_id and image_meta.file_id links carry over unchanged.
+
+    Merging replaces: the trees a shard holds (its scan roots on their hosts, and everything under them)
+    are deleted before that shard's are copied, so a shard can be merged again after rescanning it without
+    touching other shards from the same host.
+
+    The duplicate_groups triggers and the filelikes/image_meta indexes are dropped for the copy and
+    rebuilt once at the end, rather than maintained row by row. Returns the number of rows imported.
+    """
+    shard_paths = [os.path.abspath(path) for path in shard_paths]
+    filelikes = FileLikeObject.__table__
+    metas = ImageMetadata.__table__
+    imported = 0
+    with engine.connect() as conn:
+        compact = conn.execute(text("SELECT value FROM settings WHERE key = :key"), {"key": COMPACT_PATHS_SETTING}).scalar() == "1"
+        # Clear out what's being replaced while the indexes are still there to find it.
+        subtree = """WITH RECURSIVE subtree(id) AS (
+                    SELECT id FROM filelikes WHERE parent_id IS NULL AND name = :root AND host = :host
+                    UNION ALL SELECT f.id FROM filelikes f JOIN subtree ON f.parent_id = subtree.id)"""
+        for path in shard_paths:
+            conn.execute(text("ATTACH DATABASE :path AS shard"), {"path": path})
+            roots = shard_roots(conn, shard_default_host(conn, path))
+            conn.commit()
+            conn.execute(text("DETACH DATABASE shard"))
+            for (host, root) in roots:
+                conn.execute(text(f"{subtree} DELETE FROM image_meta WHERE file_id IN (SELECT id FROM subtree)"), {"host": host, "root": root})
+                conn.execute(text(f"{subtree} DELETE FROM filelikes WHERE id IN (SELECT id FROM subtree)"), {"host": host, "root": root})
+            conn.commit()
+        clear_schema_stamp(conn)
+        for (trigger,) in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'filelikes'")).all():
+            conn.execute(text(f"DROP TRIGGER {trigger}"))
+        for index in list(filelikes.indexes) + list(metas.indexes):
+            index.drop(conn, checkfirst=True)
+        conn.commit()
+
+        for path in shard_paths:
+            conn.execute(text("ATTACH DATABASE :path AS shard"), {"path": path})
+            default_host = shard_default_host(conn, path)
+            offset = conn.execute(text("SELECT COALESCE(MAX(id), 0) FROM filelikes")).scalar()
+            # Older shards may lack newer columns; those are left NULL.
+            shard_columns = set(columns_of(conn, "shard", "filelikes"))
+            columns = [c.name for c in filelikes.columns if c.name in shard_columns and c.name not in ("id", "parent_id", "host")]
+            if compact:
+                columns.remove("path")
+            selected = ", ".join(columns)
+            count = conn.execute(text(f"""
+                    INSERT INTO filelikes (id, parent_id, host, {selected})
+                    SELECT id + :offset, parent_id + :offset, COALESCE(host, :default_host), {selected} FROM shard.filelikes"""),
+                    {"offset": offset, "default_host": default_host}).rowcount
+            shard_meta_columns = set(columns_of(conn, "shard", "image_meta"))
+            meta_columns = ", ".join(c.name for c in metas.columns if c.name in shard_meta_columns and c.name not in ("id", "file_id"))
+            # Orphaned metadata (from files since rescanned) isn't worth carrying over.
+            conn.execute(text(f"""
+                    INSERT INTO image_meta (file_id, {meta_columns})
+                    SELECT file_id + :offset, {meta_columns} FROM shard.image_meta WHERE file_id IS NOT NULL"""),
+                    {"offset": offset})
+            conn.commit()
+            conn.execute(text("DETACH DATABASE shard"))
+            LOG.info(f"Imported {count} rows from {path} (hosts default to {default_host}), ids offset by {offset}")
+            imported += count
+
+        for index in list(filelikes.indexes) + list(metas.indexes):
+            index.create(conn)
+        DuplicateGroup.create_triggers(conn)
+        DuplicateView.create_view(conn)
+        conn.commit()
+    LOG.info(f"Merged {imported} rows from {len(shard_paths)} shards")
+    return imported
@@ -0,0 +1,169 @@
+import os
+
+from sqlalchemy import select, func
+from sqlalchemy.sql import text
+from sqlalchemy.schema import CreateTable
+
+from src.models.file import FileLikeObject, DatabaseSetting, DuplicateGroup, DuplicateView
+
+import logging
+import python_logging_base
+from python_logging_base import ASSERT, TODO
+
+LOG = logging.getLogger("paths")
+
+# Every row has a parent_id and a name (its basename there, or the whole absolute path if it has no parent).
+# In a compact_paths DB that's all there is: the path column is left NULL, and full paths are put back
+# together from the chain of parents when they're needed.
+COMPACT_PATHS_SETTING = "compact_paths"
+
+def is_compact(session):
+    return DatabaseSetting.get(session, COMPACT_PATHS_SETTING) == "1"
+
+
+class PathResolver(object):
+    """
+    Full paths for rows in either kind of DB. Directory paths are cached by id, so resolving every file in
+    a directory costs one recursive CTE up the tree for the first and nothing for the rest.
+    With cache_limit, the cache is dropped whenever it grows past that many paths, so long reports
+    resolve in bounded memory.
+    """
+    def __init__(self, session, cache_limit=None):
+        self.session = session
+        self.paths = {}         # id => full path
+        self.cache_limit = cache_limit
+        self.multi_host = None  # Whether located() needs to say which host, once known
+
+    def full_path(self, row):
+        """
+        Path for anything with path, parent_id and name attributes (an ORM row or a result tuple).
+        """
+        if row.path != None:
+            return row.path
+        return self.path_for(row.parent_id, row.name)
+
+    def path_for(self, parent_id, name):
+        if parent_id == None:
+            return name
+        return os.path.join(self.path_of(parent_id), name)
+
+    def located(self, row, path):
+        """
+        path, prefixed with row's host if this DB holds rows from more than one (see src.models.merge).
+        """
+        if self.multi_host == None:
+            first = self.session.execute(select(FileLikeObject.host).where(FileLikeObject.host != None).limit(1)).scalar()
+            self.multi_host = first != None and self.session.execute(
+                    select(FileLikeObject.id).where(FileLikeObject.host != first).limit(1)).first() != None
+        if self.multi_host and row.host != None:
+            return f"{row.host}:{path}"
+        return path
+
+    def directory_of(self, row):
+        """
+        Path of the directory holding row.
+        """
+        if row.parent_id != None:
+            return self.path_of(row.parent_id)
+        return os.path.dirname(self.full_path(row))
+
+    def path_of(self, flo_id):
+        if flo_id in self.paths:
+            return self.paths[flo_id]
+        if self.cache_limit != None and len(self.paths) > self.cache_limit:
+            self.paths = {}
+        chain = self.session.execute(text("""
+                WITH RECURSIVE chain(id, parent_id, name, path, depth) AS (
+                    SELECT id, parent_id, name, path, 0 FROM filelikes WHERE id = :id
+                    UNION ALL
+                    SELECT f.id, f.parent_id, f.name, f.path, chain.depth + 1 FROM filelikes f JOIN chain ON f.id = chain.parent_id
+                ) SELECT id, parent_id, name, path FROM chain ORDER BY depth DESC"""), {"id": flo_id}).all()
+        ASSERT(len(chain) > 0, f"No row with id {flo_id}")
+        path = None
+        for row in chain:
+            if row.id in self.paths:
+                path = self.paths[row.id]
+            elif row.path != None:
+                path = row.path
+            elif path == None or row.parent_id == None:
+                path = row.name
+            else:
+                path = os.path.join(path, row.name)
+            self.paths[row.id] = path
+        return path
+
+    def lookup_id(self, path, host=None):
+        """
+        The id of the (most recent) row for an absolute path (on host, if given), or None.
+        """
+        path = os.path.abspath(path)
+        if not is_compact(self.session):
+            query = select(func.max(FileLikeObject.id)).where(FileLikeObject.path == path)
+            if host != None:
+                query = query.where(FileLikeObject.on_host(host))
+            return self.session.execute(query).scalar()
+        # Start from the deepest root row containing path, then descend a name at a time.
+        roots = self.session.execute(text("""
+                SELECT id, name FROM filelikes WHERE parent_id IS NULL
+                AND (name = :path OR substr(:path, 1, length(name) + 1) = name || :sep)
+                AND (:host IS NULL OR host IS NULL OR host = :host)"""),
+                {"path": path, "sep": os.sep, "host": host}).all()
+        if len(roots) == 0:
+            return None
+        flo_id, root_name = max(roots, key=lambda r: (len(r.name), r.id))
+        for name in os.path.relpath(path, root_name).split(os.sep):
+            if name == os.curdir:
+                continue
+            flo_id = self.session.execute(
+                    select(func.max(FileLikeObject.id)).
+                    where(FileLikeObject.parent_id == flo_id).where(FileLikeObject.name == name)).scalar()
+            if flo_id == None:
+                return None
+        self.paths.setdefault(flo_id, path)
+        return flo_id
+
+
+def link_parents(connection):
+    """
+    Fill in parent_id and name for rows from before they were recorded, matching each row's
+    directory part of path to the (most recent) row with that path. Pure SQL over the path index.
+    """
+    # rtrim(path, replace(path, '/', '')) strips the basename, leaving the directory with its trailing slash.
+    directory = "rtrim(c.path, replace(c.path, '/', ''))"
+    connection.execute(text(f"""
+            UPDATE filelikes AS c SET parent_id = (
+                SELECT MAX(p.id) FROM filelikes p WHERE p.path = substr({directory}, 1, length({directory}) - 1))
+            WHERE c.parent_id IS NULL AND c.name IS NULL AND c.path != '/'"""))
+    connection.execute(text(f"""
+            UPDATE filelikes AS c SET name = CASE WHEN c.parent_id IS NULL THEN c.path ELSE substr(c.path, length({directory}) + 1) END
+            WHERE c.name IS NULL"""))
+
+
+def migrate_to_compact(engine):
+    """
+    Convert a DB to compact_paths in place: link parents, then rebuild filelikes without its full paths
+    (SQLite can't drop a NOT NULL or an index'd column's contents any other way), and VACUUM the space back.
+    """
+    with engine.begin() as conn:
+        link_parents(conn)
+        # The 12-step SQLite table rebuild: new table, copy, drop old, rename, then indexes, triggers and the view.
+        conn.execute(text("PRAGMA legacy_alter_table = ON"))
+        for (trigger,) in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'filelikes'")).all():
+            conn.execute(text(f"DROP TRIGGER {trigger}"))
+        conn.execute(text("DROP VIEW IF EXISTS view_duplicates"))
+        table = FileLikeObject.__table__
+        create = str(CreateTable(table).compile(engine)).replace("CREATE TABLE filelikes (", "CREATE TABLE filelikes_compact (", 1)
+        conn.execute(text(create))
+        columns = ", ".join(c.name for c in table.columns if c.name != "path")
+        conn.execute(text(f"INSERT INTO filelikes_compact ({columns}) SELECT {columns} FROM filelikes"))
+        conn.execute(text("DROP TABLE filelikes"))
+        conn.execute(text("ALTER TABLE filelikes_compact RENAME TO filelikes"))
+        conn.execute(text("PRAGMA legacy_alter_table = OFF"))
+        for index in table.indexes:
+            index.create(conn)
+        DuplicateGroup.create_triggers(conn)
+        DuplicateView.create_view(conn)
+        conn.execute(DatabaseSetting.__table__.insert().prefix_with("OR REPLACE"), {"key": COMPACT_PATHS_SETTING, "value": "1"})
+    with engine.connect() as conn:
+        conn.execution_options(isolation_level="AUTOCOMMIT").execute(text("VACUUM"))
+    LOG.info("Converted to compact paths")
@@ -0,0 +1,103 @@
+import queue
+import threading
+import multiprocessing
+import concurrent.futures
+
+from src.models.file import FileLikeObject
+from src.models.walker import walk, ScanConsumer
+
+import logging
+import python_logging_base
+from python_logging_base import ASSERT, TODO
+
+LOG = logging.getLogger("pipeline")
+
+
+class ScanPipeline(object):
+    """
+    Pipelined scan in three stages:
+
+    * a walker thread that lists directories and lstats every entry,
+    * a pool of workers running FileLikeObject.fingerprint_file (libmagic, imohash, EXIF) so that
+      several reads are outstanding at once,
+    * the calling thread as the single consumer; it's the only one to touch the session, and writes
+      through a BulkWriter. The walker's lookups of stored rows are run here too (see children_via_consumer).
+
+    Fingerprints complete in whatever order the pool finishes them; the ScanConsumer only writes (and
+    sizes) a directory once every child has come back.
+    """
+    def __init__(self, session, writer, progress, workers=4, use_processes=False):
+        self.session = session
+        self.writer = writer
+        self.progress = progress
+        self.workers = workers
+        self.use_processes = use_processes
+        self.events = queue.Queue()
+        # Keep the walker from running arbitrarily far ahead of the pool.
+        self.in_flight = threading.BoundedSemaphore(workers * 16)
+
+    def run(self, root):
+        self.writer.children_of = self.children_via_consumer
+        if self.use_processes:
+            # Not fork: that would copy this process, walker thread, open DB connection and all, into each worker.
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(method))
+        else:
+            pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        with pool:
+            walker = threading.Thread(target=self.walk, args=(root, pool), name="fs_buddy walker", daemon=True)
+            walker.start()
+            self.consume()
+            walker.join()
+        self.writer.finish()
+
+    # Walker thread
+
+    def walk(self, root, pool):
+        try:
+            for event in walk(root, self.writer.existing_or_new, self.progress):
+                # Announce the file before submitting it, so its result can never arrive before it.
+                self.events.put(event)
+                kind, flo, parent, refreshed = event
+                if kind == "file" and refreshed == FileLikeObject.REFRESH_FINGERPRINTED:
+                    self.in_flight.acquire()
+                    future = pool.submit(FileLikeObject.fingerprint_file, flo.path, not self.progress.defer_fingerprints)
+                    future.add_done_callback(lambda f, flo=flo: self.fingerprinted(flo, f))
+            self.events.put(("walk_done", None, None, None))
+        except BaseException as e:
+            self.events.put(("failed", e, None, None))
+
+    def children_via_consumer(self, directory_id):
+        """
+        BulkWriter.children_of for the walker thread: hand the query to the consumer and wait for the rows.
+        """
+        rows = concurrent.futures.Future()
+        self.events.put(("children", directory_id, rows, None))
+        return rows.result()
+
+    def fingerprinted(self, flo, future):
+        self.in_flight.release()
+        self.events.put(("fingerprinted", flo, future, None))
+
+    # Consumer (calling thread)
+
+    def consume(self):
+        consumer = ScanConsumer(self.writer, self.progress)
+        walk_done = False
+        while not walk_done or len(consumer.awaiting) > 0:
+            event = self.events.get()
+            kind = event[0]
+            if kind == "fingerprinted":
+                consumer.fingerprinted(event[1], event[2].result())
+            elif kind == "walk_done":
+                walk_done = True
+            elif kind == "failed":
+                raise event[1]
+            elif kind == "children":
+                try:
+                    event[2].set_result(self.writer.stored_children(event[1]))
+                except BaseException as e:
+                    event[2].set_exception(e)
+                    raise
+            else:
+                consumer.handle(event)
@@ -0,0 +1,247 @@
+import os
+import csv
+import json
+import sqlite3
+
+import logging
+import python_logging_base
+from python_logging_base import ASSERT, TODO
+
+LOG = logging.getLogger("reports")
+
+# Reports stream plain tuples, one per output row, a page at a time. Each page is a fresh query that
+# starts strictly after the last row of the one before (keyset pagination), rather than an OFFSET or a
+# cursor held open across the whole result, so memory stays flat however many rows there are.
+#
+# They only read, so they go through the stdlib sqlite3 module with plain SQL: no SQLAlchemy and no ORM
+# models to import, which is most of what a short report would otherwise spend its time on.
+PAGE_SIZE = 5000
+PATH_CACHE_LIMIT = 100000
+# The rows a duplicate_groups group counts; the same test as DuplicateGroup.member_condition("f").
+MEMBER_CONDITION = "f.fingerprint IS NOT NULL AND f.tree_size_bytes IS NOT NULL AND NOT COALESCE(f.directory, 0) " \
+        "AND (f.fingerprint_type IS NULL OR f.fingerprint_type != 'error')"
+
+
+def open_read_only(path):
+    """
+    A sqlite3 connection to the existing DB at path that can't write to it. Unlike bind_file_db, a
+    missing DB is an error rather than a new empty one.
+    """
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"No DB at {path}")
+    return sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+
+
+def keyset_pages(connection, query, key, page_size=PAGE_SIZE):
+    """
+    Yields every row of query(after) a page at a time, where after is None for the first page and
+    key(last row) for the rest; query returns (sql, parameters), must order by what key returns and
+    start after it.
+    """
+    after = None
+    while True:
+        (sql, parameters) = query(after)
+        cursor = connection.cursor()
+        cursor.row_factory = sqlite3.Row
+        rows = cursor.execute(f"{sql} LIMIT ?", (*parameters, page_size)).fetchall()
+        yield from rows
+        if len(rows) < page_size:
+            return
+        after = key(rows[-1])
+
+
+class ReportPaths(object):
+    """
+    src.models.paths.PathResolver.full_path and located over a sqlite3 connection, for rows with path,
+    parent_id, name and host columns. Directory paths are cached by id, dropped whenever there are more
+    than cache_limit of them.
+    """
+    def __init__(self, connection, cache_limit=PATH_CACHE_LIMIT):
+        self.connection = connection
+        self.paths = {}         # id => full path
+        self.cache_limit = cache_limit
+        self.multi_host = None
+
+    def full_path(self, row):
+        if row["path"] != None:
+            return row["path"]
+        if row["parent_id"] == None:
+            return row["name"]
+        return os.path.join(self.path_of(row["parent_id"]), row["name"])
+
+    def path_of(self, flo_id):
+        if flo_id in self.paths:
+            return self.paths[flo_id]
+        if len(self.paths) > self.cache_limit:
+            self.paths = {}
+        chain = self.connection.execute("""
+                WITH RECURSIVE chain(id, parent_id, name, path, depth) AS (
+                    SELECT id, parent_id, name, path, 0 FROM filelikes WHERE id = ?
+                    UNION ALL
+                    SELECT f.id, f.parent_id, f.name, f.path, chain.depth + 1 FROM filelikes f JOIN chain ON f.id = chain.parent_id
+                ) SELECT id, parent_id, name, path FROM chain ORDER BY depth DESC""", (flo_id,)).fetchall()
+        ASSERT(len(chain) > 0, f"No row with id {flo_id}")
+        path = None
+        for (row_id, parent_id, name, row_path) in chain:
+            if row_id in self.paths:
+                path = self.paths[row_id]
+            elif row_path != None:
+                path = row_path
+            elif path == None or parent_id == None:
+                path = name
+            else:
+                path = os.path.join(path, name)
+            self.paths[row_id] = path
+        return path
+
+    def located(self, row):
+        """
+        The row's full path, prefixed with its host if this DB holds rows from more than one.
+        """
+        if self.multi_host == None:
+            first = self.connection.execute("SELECT host FROM filelikes WHERE host IS NOT NULL LIMIT 1").fetchone()
+            self.multi_host = first != None and self.connection.execute(
+                    "SELECT id FROM filelikes WHERE host != ? LIMIT 1", first).fetchone() != None
+        path = self.full_path(row)
+        if self.multi_host and row["host"] != None:
+            return f"{row['host']}:{path}"
+        return path
+
+
+class Report(object):
+    """
+    A named query with its output columns. Subclasses define rows(connection), which yields tuples in
+    that column order from a sqlite3 connection (see open_read_only).
+    """
+    name = None
+    columns = ()
+
+    def __init__(self, page_size=PAGE_SIZE):
+        self.page_size = page_size
+
+
+class DuplicateFilesReport(Report):
+    """
+    Every file in a duplicate group, the groups that would free the most space first.
+    Pages are page_size groups rather than rows: the groups come off the end of
+    ix_duplicate_groups_wasted_bytes_fingerprint_tree_size_bytes as a range, and their members
+    through ix_filelikes_fingerprint, so no page costs more than its own rows.
+    """
+    name = "duplicates"
+    columns = ("wasted_bytes", "fingerprint", "tree_size_bytes", "member_count", "id", "path")
+
+    def query(self, after):
+        """
+        (sql, parameters) for the members of the page_size groups after the group key after (or the first ones).
+        """
+        where = ""
+        parameters = ()
+        if after != None:
+            where = "AND (wasted_bytes, fingerprint, tree_size_bytes) < (?, ?, ?)"
+            parameters = after
+        # All descending, matching the index, so the row value comparison is a range on it. The unary + keeps
+        # the planner off ix_filelikes_tree_size_bytes for the members, which is far less selective than the fingerprint.
+        return (f"""SELECT g.wasted_bytes, g.fingerprint, g.tree_size_bytes, g.member_count, f.id, f.path, f.parent_id, f.name, f.host
+                FROM (SELECT wasted_bytes, fingerprint, tree_size_bytes, member_count FROM duplicate_groups
+                    WHERE member_count > 1 {where}
+                    ORDER BY wasted_bytes DESC, fingerprint DESC, tree_size_bytes DESC LIMIT ?) g
+                JOIN filelikes f ON f.fingerprint = g.fingerprint AND +f.tree_size_bytes = g.tree_size_bytes
+                WHERE {MEMBER_CONDITION}
+                ORDER BY g.wasted_bytes DESC, g.fingerprint DESC, g.tree_size_bytes DESC, f.id""", (*parameters, self.page_size))
+
+    def rows(self, connection):
+        paths = ReportPaths(connection)
+        after = None
+        while True:
+            (sql, parameters) = self.query(after)
+            cursor = connection.cursor()
+            cursor.row_factory = sqlite3.Row
+            rows = cursor.execute(sql, parameters).fetchall()
+            for row in rows:
+                yield (row["wasted_bytes"], row["fingerprint"], row["tree_size_bytes"], row["member_count"], row["id"], paths.located(row))
+            groups = set((row["fingerprint"], row["tree_size_bytes"]) for row in rows)
+            if len(groups) < self.page_size:
+                return
+            after = (rows[-1]["wasted_bytes"], rows[-1]["fingerprint"], rows[-1]["tree_size_bytes"])
+
+
+class LargestReport(Report):
+    """
+    Directories (or, with files, everything) by tree_size_bytes, biggest first.
+    """
+    name = "largest"
+    columns = ("tree_size_bytes", "directory", "id", "path")
+
+    def __init__(self, page_size=PAGE_SIZE, files=False):
+        super().__init__(page_size)
+        self.files = files
+
+    def rows(self, connection):
+        def query(after):
+            where = "" if self.files else "AND directory = 1"
+            parameters = ()
+            if after != None:
+                where += " AND (tree_size_bytes, id) < (?, ?)"
+                parameters = after
+            # Both descending, so SQLite walks the tree_size_bytes index backwards without sorting.
+            return (f"""SELECT tree_size_bytes, directory, id, path, parent_id, name, host FROM filelikes
+                    WHERE tree_size_bytes IS NOT NULL {where}
+                    ORDER BY tree_size_bytes DESC, id DESC""", parameters)
+        key = lambda row: (row["tree_size_bytes"], row["id"])
+        paths = ReportPaths(connection)
+        for row in keyset_pages(connection, query, key, self.page_size):
+            yield (row["tree_size_bytes"], bool(row["directory"]), row["id"], paths.located(row))
+
+
+class DuplicateFoldersReport(Report):
+    """
+    Every directory whose whole tree is identical to another's (see DuplicateView.identical_folders),
+    biggest first, with the copies of each tree next to each other. Empty trees are left out.
+    Pages are ranges on ix_filelikes_tree_size_bytes_subtree_fingerprint, walked backwards.
+    """
+    name = "folders"
+    columns = ("tree_size_bytes", "subtree_fingerprint", "id", "path")
+
+    def query(self, after):
+        where = ""
+        parameters = ()
+        if after != None:
+            where = "AND (f.tree_size_bytes, f.subtree_fingerprint, f.id) < (?, ?, ?)"
+            parameters = after
+        # All descending, matching the index (whose entries end in the rowid), so there's nothing to sort.
+        return (f"""SELECT f.tree_size_bytes, f.subtree_fingerprint, f.id, f.path, f.parent_id, f.name, f.host FROM filelikes f
+                WHERE f.subtree_fingerprint IS NOT NULL AND f.tree_size_bytes > 0 AND f.directory = 1
+                AND EXISTS (SELECT 1 FROM filelikes other WHERE other.subtree_fingerprint = f.subtree_fingerprint AND other.id != f.id)
+                {where}
+                ORDER BY f.tree_size_bytes DESC, f.subtree_fingerprint DESC, f.id DESC""", parameters)
+
+    def rows(self, connection):
+        key = lambda row: (row["tree_size_bytes"], row["subtree_fingerprint"], row["id"])
+        paths = ReportPaths(connection)
+        for row in keyset_pages(connection, self.query, key, self.page_size):
+            yield (row["tree_size_bytes"], row["subtree_fingerprint"], row["id"], paths.located(row))
+
+
+REPORTS = {report.name: report for report in (DuplicateFilesReport, LargestReport, DuplicateFoldersReport)}
+
+
+def write_jsonl(columns, rows, out):
+    count = 0
+    for row in rows:
+        out.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+        out.write("\n")
+        count += 1
+    return count
+
+
+def write_csv(columns, rows, out):
+    writer = csv.writer(out)
+    writer.writerow(columns)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+    return count
+
+
+WRITERS = {"jsonl": write_jsonl, "csv": write_csv}
@@ -0,0 +1,158 @@
+import itertools
+from sqlalchemy import select, or_
+
+from src.models.file import FileLikeObject, ImageMetadata
+
+import logging
+import python_logging_base
+from python_logging_base import ASSERT, TODO
+
+LOG = logging.getLogger("similar")
+
+# A 64 bit difference hash, split into BANDS bands of BAND_BITS bits for multi-index hashing: if two
+# hashes are within k bits of each other, at least one of their bands is within k // BANDS bits.
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+BANDS = 4
+BAND_BITS = HASH_BITS // BANDS
+
+
+def perceptual_hash(path):
+    """
+    dHash of an image: shrink to 9x8 greyscale and record whether each pixel is darker than its right
+    neighbour. Survives resizing, re-encoding and small edits; returns an int of HASH_BITS bits.
+
+    JPEGs are decoded at a reduced scale (draft) rather than in full, and anything else is reduced by
+    an integer factor before the final resize.
+    """
+    from PIL import Image
+    with Image.open(path) as img:
+        img.draft("L", (HASH_SIZE * 8, HASH_SIZE * 8))
+        small = img.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR, reducing_gap=2.0)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            value = (value << 1) | (left < pixels[row * (HASH_SIZE + 1) + col + 1])
+    return value
+
+
+def to_hex(value):
+    return f"{value:0{HASH_BITS // 4}x}"
+
+
+def bands(value):
+    """
+    The hash's BANDS bands, most significant first.
+    """
+    mask = (1 << BAND_BITS) - 1
+    return [(value >> (BAND_BITS * (BANDS - 1 - band))) & mask for band in range(BANDS)]
+
+
+def distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+def within_radius(value, radius, bits=BAND_BITS):
+    """
+    Every value of the given width that differs from value in at most radius bits, value included.
+    """
+    for flips in range(radius + 1):
+        for positions in itertools.combinations(range(bits), flips):
+            flipped = value
+            for position in positions:
+                flipped ^= 1 << position
+            yield flipped
+
+
+class MultiIndexHash(object):
+    """
+    In-memory multi-index hashing over perceptual hashes: one dict per band from band value to keys.
+    A query for everything within k bits only probes band values within k // BANDS bits of its own,
+    then checks the full distance of those candidates, instead of comparing against every hash.
+    """
+    def __init__(self):
+        self.hashes = {}                                # key => hash
+        self.tables = [{} for _ in range(BANDS)]        # band value => [keys], per band
+
+    def add(self, key, value):
+        self.hashes[key] = value
+        for table, band_value in zip(self.tables, bands(value)):
+            table.setdefault(band_value, []).append(key)
+
+    def within(self, value, k):
+        """
+        Yields (key, distance) for every hash within k bits of value.
+        """
+        radius = k // BANDS
+        seen = set()
+        for table, band_value in zip(self.tables, bands(value)):
+            for probe in within_radius(band_value, radius):
+                for key in table.get(probe, ()):
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    d = distance(value, self.hashes[key])
+                    if d <= k:
+                        yield (key, d)
+
+    def pairs(self, k):
+        """
+        Yields (key, key, distance) for every pair of hashes within k bits of each other, each pair once.
+        """
+        keys = {key: n for (n, key) in enumerate(self.hashes)}
+        for key, value in self.hashes.items():
+            for other, d in self.within(value, k):
+                if keys[other] > keys[key]:
+                    yield (key, other, d)
+
+
+def current_hashes(session):
+    """
+    Streams (file id, hash) for every file's current image metadata that has a perceptual hash.
+    """
+    rows = session.execute(
+            select(ImageMetadata.file_id, ImageMetadata.perceptual_hash).
+            where(ImageMetadata.file_id != None).where(ImageMetadata.perceptual_hash != None).
+            execution_options(yield_per=10000))
+    for (file_id, perceptual_hash) in rows:
+        yield (file_id, int(perceptual_hash, 16))
+
+
+def similar_to(session, value, k):
+    """
+    (file id, distance) for every stored image within k bits of the hash value, nearest first.
+    Probes the indexed perceptual_band_* columns, so only images sharing a (nearby) band are read.
+    """
+    radius = k // BANDS
+    columns = [getattr(ImageMetadata, f"perceptual_band_{band}") for band in range(BANDS)]
+    criteria = [column.in_(list(within_radius(band_value, radius))) for (column, band_value) in zip(columns, bands(value))]
+    rows = session.execute(
+            select(ImageMetadata.file_id, ImageMetadata.perceptual_hash).
+            where(ImageMetadata.file_id != None).where(or_(*criteria)))
+    found = {}
+    for (file_id, perceptual_hash) in rows:
+        d = distance(value, int(perceptual_hash, 16))
+        if d <= k:
+            found[file_id] = d
+    return sorted(found.items(), key=lambda item: (item[1], item[0]))
+
+
+def near_duplicate_images(session, k=6):
+    """
+    Yields (path, path, distance) for every pair of stored images within k bits of each other, nearest first.
+    """
+    from src.models.paths import PathResolver
+    index = MultiIndexHash()
+    for (file_id, value) in current_hashes(session):
+        index.add(file_id, value)
+    LOG.info(f"Indexed {len(index.hashes)} perceptual hashes")
+    resolver = PathResolver(session)
+    paths = {}
+    def path(file_id):
+        if file_id not in paths:
+            paths[file_id] = resolver.full_path(session.get(FileLikeObject, file_id))
+        return paths[file_id]
+    for (a, b, d) in sorted(index.pairs(k), key=lambda pair: pair[2]):
+        yield tuple(sorted((path(a), path(b)))) + (d,)
@@ -0,0 +1,178 @@
+import os
+import time
+
+from src.models.file import FileLikeObject
+
+import logging
+import python_logging_base
+from python_logging_base import ASSERT, TODO
+
+LOG = logging.getLogger("walker")
+
+
+def walk(root, existing_or_new, progress):
+    """
+    Iterative, depth-first walk from root, streaming events as it goes.
+
+    Yields (kind, flo, parent, refreshed) tuples, where parent is the containing directory's
+    FileLikeObject (None for root) and refreshed is what flo.refresh_stat returned:
+
+    * "enter" - a directory, before any of its children
+    * "file" - anything that isn't a directory; fingerprint_file is still due if refreshed says so
+    * "unreadable" - a directory we couldn't list; it gets no children
+    * "completed" - a directory a resumed scan already finished (see progress.completed); not descended into
+    * "leave" - a directory, after all of its children
+
+    An explicit stack of (directory, remaining entries) replaces recursion, so depth is only bounded
+    by memory. Each directory is listed in one go rather than holding a scandir iterator (and so a
+    file descriptor) open per level.
+    """
+    instruments = progress.instruments
+    stack = []
+    flo, parent = root, None
+    while True:
+        if flo != None:
+            start = time.perf_counter()
+            refreshed = flo.refresh_stat(progress.incremental)
+            instruments.record("lstat", time.perf_counter() - start)
+            if not flo.directory:
+                yield ("file", flo, parent, refreshed)
+            elif flo.id in progress.completed:
+                yield ("completed", flo, parent, refreshed)
+            else:
+                yield ("enter", flo, parent, refreshed)
+                start = time.perf_counter()
+                try:
+                    with os.scandir(flo.path) as iterator:
+                        entries = [(entry.path, entry.inode()) for entry in iterator]
+                except PermissionError as p:
+                    LOG.error(f"Did not have permission to descend into {flo.path}")
+                    yield ("unreadable", flo, parent, refreshed)
+                    entries = []
+                instruments.record("scandir", time.perf_counter() - start)
+                progress.discovered += len(entries)
+                stack.append((flo, parent, iter(entries)))
+        if len(stack) == 0:
+            return
+        directory, directory_parent, remaining = stack[-1]
+        entry = next(remaining, None)
+        if entry == None:
+            stack.pop()
+            yield ("leave", directory, directory_parent, None)
+            flo = None
+            continue
+        start = time.perf_counter()
+        flo, parent = existing_or_new(entry[0], entry[1], directory), directory
+        instruments.record("lookup", time.perf_counter() - start)
+
+
+class DirectoryState(object):
+    """
+    Bookkeeping for a directory whose children are still in flight.
+    A directory can only be written once it has been fully listed *and* every child has been written.
+    """
+    def __init__(self, flo, parent):
+        self.flo = flo
+        self.parent = parent            # DirectoryState of the containing directory, None for the root
+        self.pending = 0                # Children seen but not yet written
+        self.listed = False             # The walk has left this directory
+        self.readable = True
+        self.aggregated_bytes = 0
+        self.children = []              # (name, merkle leaf) of every child written so far
+
+
+class ScanConsumer(object):
+    """
+    Turns walk events into writes, aggregating directory sizes and subtree fingerprints as each
+    directory finishes.
+
+    Files whose fingerprint is due are held until fingerprinted() is called with the result of
+    FileLikeObject.fingerprint_file, which can happen in any order relative to other events.
+    """
+    def __init__(self, writer, progress):
+        self.writer = writer
+        self.progress = progress
+        self.directories = {}           # id(FileLikeObject) => DirectoryState
+        self.awaiting = {}              # id(FileLikeObject) => parent DirectoryState, for files being fingerprinted
+
+    def handle(self, event):
+        """
+        Returns True if this is a file whose fingerprint_file result must be handed to fingerprinted().
+        """
+        kind, flo, parent, refreshed = event
+        if kind == "leave":
+            state = self.directories[id(flo)]
+            state.listed = True
+            self.finish_if_done(state)
+            return False
+        if kind == "unreadable":
+            self.directories[id(flo)].readable = False
+            return False
+        parent_state = self.directories.get(id(parent)) if parent != None else None
+        if parent_state != None:
+            parent_state.pending += 1
+        if kind == "completed":
+            # Its stored size and subtree fingerprint are already right.
+            self.progress.resumed += 1
+            self.complete(flo, parent_state)
+            return False
+        if kind == "enter":
+            # Written now (and again once sized) so that children can be linked to it.
+            self.writer.add(flo)
+            self.directories[id(flo)] = DirectoryState(flo, parent_state)
+            return False
+        if refreshed == FileLikeObject.REFRESH_FINGERPRINTED:
+            self.awaiting[id(flo)] = parent_state
+            return True
+        if refreshed == FileLikeObject.REFRESH_SKIPPED:
+            self.progress.skipped += 1
+        self.complete(flo, parent_state)
+        return False
+
+    def fingerprinted(self, flo, result):
+        parent_state = self.awaiting.pop(id(flo))
+        self.progress.instruments.record_all(result["timings"])
+        flo.apply_fingerprint(result)
+        self.progress.fingerprinted += 1
+        self.complete(flo, parent_state)
+
+    def complete(self, flo, parent_state, write=True):
+        """
+        Write flo and fold it into its parent, then keep going up for as long as that finishes
+        directories. A loop rather than recursion, so a late fingerprint at the bottom of a deep
+        tree can't blow the stack.
+        """
+        while True:
+            if write:
+                self.writer.add(flo)
+                if flo.directory and self.progress.scan_id != None and flo.id not in self.progress.completed:
+                    self.writer.checkpoint(self.progress.scan_id, flo, self.progress)
+            self.progress.entry_done()
+            if parent_state == None:
+                return
+            if flo.tree_size_bytes != None: # This can happen when e.g. a folder doesn't have permissions - it's effectively 0 bytes to us.
+                parent_state.aggregated_bytes += flo.tree_size_bytes
+            # We don't know what's in an unreadable directory, so neither do we for anything containing it.
+            parent_state.children.append((os.path.basename(flo.path), flo.merkle_leaf() if write else None))
+            parent_state.pending -= 1
+            if not parent_state.listed or parent_state.pending > 0:
+                return
+            flo, parent_state, write = self.finished(parent_state)
+
+    def finish_if_done(self, state):
+        if not state.listed or state.pending > 0:
+            return
+        self.complete(*self.finished(state))
+
+    def finished(self, state):
+        """
+        Stop tracking a directory whose children have all been written.
+        Returns (flo, parent_state, write) for complete().
+        """
+        del self.directories[id(state.flo)]
+        if state.readable:
+            # OK, every child has been written. Now "this" size and fingerprint should be accurate.
+            state.flo.tree_size_bytes = state.aggregated_bytes
+            state.flo.subtree_fingerprint = FileLikeObject.combine_subtree(state.children)
+        # An unreadable directory isn't written again, and counts as its stored size (if any).
+        return (state.flo, state.parent, state.readable)
@@ -0,0 +1,420 @@
+import os
+import stat
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from sqlalchemy import update, func
+from sqlalchemy.sql import text
+
+from src.models.file import FileLikeObject, DatabaseSetting
+from src.models.paths import PathResolver, is_compact
+
+import logging
+import python_logging_base
+from python_logging_base import ASSERT, TODO
+
+LOG = logging.getLogger("watch")
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+        IN_DELETE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+EVENT_HEADER = struct.Struct("iIII")     # wd, mask, cookie, len; then len bytes of NUL padded name
+
+
+class Inotify(object):
+    """
+    Just enough of inotify(7), through ctypes: one watch per directory, and events as
+    (directory, name, mask, cookie) with the directory each watch was added for.
+    """
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.add_watch_call = libc.inotify_add_watch
+        self.add_watch_call.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.rm_watch_call = libc.inotify_rm_watch
+        self.rm_watch_call.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"inotify_init1: {os.strerror(error)}")
+        self.directories = {}       # wd => directory path
+        self.wds = {}               # directory path => wd
+
+    def add_watch(self, directory):
+        wd = self.add_watch_call(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                LOG.error(f"Out of inotify watches watching {directory}; raise fs.inotify.max_user_watches")
+            elif error not in (errno.ENOENT, errno.ENOTDIR):   # Gone again already; its deletion is on its way
+                LOG.error(f"Could not watch {directory}: {os.strerror(error)}")
+            return
+        self.directories[wd] = directory
+        self.wds[directory] = wd
+
+    def watch_tree(self, root):
+        """
+        Watch root and every directory under it, iteratively.
+        """
+        stack = [root]
+        while len(stack) > 0:
+            directory = stack.pop()
+            self.add_watch(directory)
+            try:
+                with os.scandir(directory) as entries:
+                    stack.extend(entry.path for entry in entries if entry.is_dir(follow_symlinks=False))
+            except OSError as e:
+                LOG.error(f"Could not list {directory} to watch it: {e}")
+
+    def under(self, directory):
+        prefix = directory.rstrip(os.sep) + os.sep
+        return [path for path in self.wds if path == directory or path.startswith(prefix)]
+
+    def moved(self, source, destination):
+        """
+        A watched directory keeps its wd through a rename; just follow it, and everything under it.
+        """
+        for path in self.under(source):
+            wd = self.wds.pop(path)
+            path = destination + path[len(source):]
+            self.directories[wd] = path
+            self.wds[path] = wd
+
+    def unwatch_tree(self, directory):
+        for path in self.under(directory):
+            wd = self.wds.pop(path)
+            self.directories.pop(wd, None)
+            self.rm_watch_call(self.fd, wd)     # Fails harmlessly if the kernel already dropped it
+
+    def read(self, timeout):
+        """
+        Events available within timeout seconds, as a list of (directory, name, mask, cookie).
+        Overflow comes through as (None, None, IN_Q_OVERFLOW, 0).
+        """
+        ready, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+        if len(ready) == 0:
+            return []
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0"))
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, None, mask, cookie))
+                continue
+            if mask & IN_IGNORED:
+                directory = self.directories.pop(wd, None)
+                if directory != None and self.wds.get(directory) == wd:
+                    del self.wds[directory]
+                continue
+            directory = self.directories.get(wd)
+            if directory != None:
+                events.append((directory, name, mask, cookie))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def is_under(path, directory):
+    return path == directory or path.startswith(directory.rstrip(os.sep) + os.sep)
+
+
+class ChangeSet(object):
+    """
+    Events coalesced between flushes: at most one "refresh" or "delete" per path, plus the renames
+    in the order they happened. A rename carries the pending changes under its source along to its
+    destination, and supersedes anything pending at the destination, so applying every rename first
+    and then the per-path changes gives the same end state as the events did.
+    """
+    def __init__(self):
+        self.ops = {}               # path => "refresh" or "delete"
+        self.moves = []             # (source, destination, is_directory), in order
+        self.moved_from = {}        # cookie => (source, is_directory), waiting for its IN_MOVED_TO
+        self.overflowed = False
+        self.first_event = None
+        self.last_event = None
+
+    def __len__(self):
+        return len(self.ops) + len(self.moves) + (1 if self.overflowed else 0)
+
+    def add(self, directory, name, mask, cookie):
+        now = time.monotonic()
+        if self.first_event == None:
+            self.first_event = now
+        self.last_event = now
+        if mask & IN_Q_OVERFLOW:
+            self.overflowed = True
+            return
+        path = os.path.join(directory, name) if name else directory
+        if mask & IN_MOVED_FROM:
+            # Until the other half turns up, it's gone (it may have left the watched trees).
+            self.moved_from[cookie] = (path, bool(mask & IN_ISDIR))
+            self.ops[path] = "delete"
+        elif mask & IN_MOVED_TO:
+            self.moved_to(cookie, path)
+        elif mask & (IN_DELETE | IN_DELETE_SELF):
+            if name:                    # DELETE_SELF is also reported as a DELETE in the parent
+                self.ops[path] = "delete"
+        else:
+            self.ops[path] = "refresh"
+
+    def moved_to(self, cookie, destination):
+        source = self.moved_from.pop(cookie, None)
+        if source == None:
+            # Moved in from outside anything watched: new as far as we know.
+            self.ops[destination] = "refresh"
+            return
+        source, is_directory = source
+        ops = {}
+        for path, op in self.ops.items():
+            if path == source and op == "delete":
+                continue
+            if is_under(path, destination):
+                continue
+            if is_under(path, source):
+                path = destination + path[len(source):]
+            ops[path] = op
+        self.ops = ops
+        self.moves.append((source, destination, is_directory))
+
+
+class Watcher(object):
+    """
+    Keeps the DB current for the watched roots from inotify events instead of rescanning.
+
+    Events are coalesced (see ChangeSet) until debounce seconds pass without one, or max_delay seconds
+    after the first, then applied in one transaction:
+
+    * a rename updates the moved row's parent_id and name (and, unless the DB is compact_paths, the
+      paths of everything under it with one UPDATE); nothing is fingerprinted again,
+    * a delete removes the row and everything under it,
+    * anything else goes through fs_refresh (incrementally, so a touch doesn't re-hash), and a new
+      directory is walked into the same transaction,
+
+    and then each affected directory's tree_size_bytes change is added up its parent_id chain, and
+    the subtree fingerprints along those chains are recomputed from each directory's children.
+    If the kernel's queue overflows, the roots are rescanned incrementally instead.
+    """
+    def __init__(self, session, roots, debounce=0.5, max_delay=5.0):
+        self.session = session
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.host = DatabaseSetting.host(session)
+        self.compact = is_compact(session)
+        self.inotify = Inotify()
+        self.changes = ChangeSet()
+
+    def start(self, scan=True):
+        """
+        Watch the roots; then (with scan) catch up on anything that changed before the watches were in place.
+        """
+        for root in self.roots:
+            self.inotify.watch_tree(root)
+        LOG.info(f"Watching {len(self.inotify.wds)} directories under {', '.join(self.roots)}")
+        if scan:
+            for root in self.roots:
+                FileLikeObject.scan_recursively(FileLikeObject(path=root), incremental=True)
+
+    def run(self):
+        while True:
+            self.process(3600)
+
+    def process(self, timeout):
+        """
+        Wait up to timeout seconds for events, and apply them once they settle.
+        Returns True if a batch of changes was applied.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            if len(self.changes) > 0:
+                due = min(self.changes.last_event + self.debounce, self.changes.first_event + self.max_delay)
+                if now >= due:
+                    self.flush()
+                    return True
+                wait = due - now
+            else:
+                if now >= deadline:
+                    return False
+                wait = deadline - now
+            for event in self.inotify.read(wait):
+                self.changes.add(*event)
+
+    def flush(self):
+        changes, self.changes = self.changes, ChangeSet()
+        if changes.overflowed:
+            LOG.warning("inotify queue overflowed; rescanning")
+            for root in self.roots:
+                self.inotify.watch_tree(root)
+                FileLikeObject.scan_recursively(FileLikeObject(path=root), incremental=True)
+            return
+        self.resolver = PathResolver(self.session)
+        self.deltas = {}        # directory id => change in tree_size_bytes of its children
+        for (source, destination, is_directory) in changes.moves:
+            self.apply_move(source, destination, is_directory)
+        for path, op in changes.ops.items():
+            if op == "delete":
+                self.apply_delete(path)
+        # Parents first, so a new directory is in place before anything in it.
+        for path in sorted((path for (path, op) in changes.ops.items() if op == "refresh"), key=lambda path: path.count(os.sep)):
+            self.apply_refresh(path)
+        self.propagate()
+        self.session.commit()
+        LOG.info(f"Applied {len(changes.moves)} renames and {len(changes.ops)} other changes")
+
+    # Applying changes
+
+    def lookup(self, path):
+        flo_id = self.resolver.lookup_id(path, self.host)
+        return self.session.get(FileLikeObject, flo_id) if flo_id != None else None
+
+    def adjust(self, parent_id, delta):
+        if parent_id != None and delta:
+            self.deltas[parent_id] = self.deltas.get(parent_id, 0) + delta
+
+    def apply_move(self, source, destination, is_directory):
+        if is_directory:
+            self.inotify.moved(source, destination)
+        flo = self.lookup(source)
+        parent = self.lookup(os.path.dirname(destination))
+        if flo == None or parent == None:
+            # Never recorded (e.g. created and renamed within this batch): just look at what's there now.
+            self.apply_refresh(destination)
+            return
+        replaced = self.lookup(destination)
+        if replaced != None and replaced.id != flo.id:
+            self.apply_delete(destination)
+        size = flo.tree_size_bytes or 0
+        self.adjust(flo.parent_id, -size)
+        self.adjust(parent.id, size)
+        flo.parent_id = parent.id
+        flo.name = os.path.basename(destination)
+        if flo.path != None:
+            flo.path = destination
+            if is_directory:
+                self.session.flush()
+                prefix = source.rstrip(os.sep) + os.sep
+                self.session.execute(update(FileLikeObject).
+                        where(FileLikeObject.under_filter(source)).where(FileLikeObject.on_host(self.host)).
+                        values(path=destination + os.sep + func.substr(FileLikeObject.path, len(prefix) + 1)).
+                        execution_options(synchronize_session=False))
+                self.session.expire_all()
+        self.session.flush()
+        self.resolver = PathResolver(self.session)
+
+    def apply_delete(self, path):
+        flo = self.lookup(path)
+        if flo == None:
+            return
+        if flo.directory:
+            self.inotify.unwatch_tree(path)
+        self.adjust(flo.parent_id, -(flo.tree_size_bytes or 0))
+        self.session.flush()
+        subtree = """WITH RECURSIVE subtree(id) AS (
+                    SELECT :id UNION ALL SELECT f.id FROM filelikes f JOIN subtree ON f.parent_id = subtree.id)"""
+        self.session.execute(text(f"{subtree} DELETE FROM image_meta WHERE file_id IN (SELECT id FROM subtree)"), {"id": flo.id})
+        self.session.execute(text(f"{subtree} DELETE FROM filelikes WHERE id IN (SELECT id FROM subtree)"), {"id": flo.id})
+        self.session.expire_all()
+        self.resolver = PathResolver(self.session)
+
+    def apply_refresh(self, path):
+        try:
+            f_stat = os.lstat(path)
+        except FileNotFoundError:
+            self.apply_delete(path)
+            return
+        parent = self.lookup(os.path.dirname(path))
+        if parent == None:
+            LOG.error(f"No row for the directory holding {path}; skipping it until the next scan")
+            return
+        flo = self.lookup(path)
+        if flo != None and (flo.inode != f_stat.st_ino or bool(flo.directory) != stat.S_ISDIR(f_stat.st_mode)):
+            # Something else under the same name now.
+            self.apply_delete(path)
+            flo = None
+        if flo == None and stat.S_ISDIR(f_stat.st_mode):
+            self.add_directory(path, parent)
+            return
+        if flo == None:
+            flo = FileLikeObject(path=path)
+            self.session.add(flo)
+        old_size = (flo.tree_size_bytes or 0) if not flo.directory else 0
+        flo.path = path
+        flo.fs_refresh(incremental=True)
+        flo.place_under(parent.id)
+        flo.host = self.host
+        if self.compact:
+            flo.path = None
+        if not flo.directory:
+            self.adjust(parent.id, (flo.tree_size_bytes or 0) - old_size)
+        else:
+            # A directory's own stat changing doesn't change what's under it.
+            self.deltas.setdefault(parent.id, 0)
+        self.session.flush()
+
+    def add_directory(self, path, parent):
+        """
+        Walk a directory that's new under parent into this batch's transaction: written through a
+        BulkWriter that doesn't commit, and not recorded as a ScanSession, so the batch (propagate
+        included) still commits as one.
+        """
+        from src.models.file import ScanProgress
+        from src.models.ingest import BulkWriter
+        from src.models.walker import walk, ScanConsumer
+        self.inotify.watch_tree(path)
+        # BulkWriter hands out ids past the highest stored one, so everything pending has to be in the DB first.
+        self.session.flush()
+        writer = BulkWriter(self.session, path, commits=False)
+        progress = ScanProgress(0, incremental=True)
+        # A transient stand-in for parent, with its full path (a compact_paths DB doesn't store it).
+        parent = FileLikeObject(id=parent.id, parent_id=parent.parent_id, path=os.path.dirname(path))
+        flo = writer.existing_or_new(path, os.lstat(path).st_ino, parent)
+        consumer = ScanConsumer(writer, progress)
+        for event in walk(flo, writer.existing_or_new, progress):
+            if consumer.handle(event):
+                consumer.fingerprinted(event[1], FileLikeObject.fingerprint_file(event[1].path))
+        writer.finish()
+        self.adjust(parent.id, flo.tree_size_bytes or 0)
+        self.resolver = PathResolver(self.session)
+
+    # Keeping directories up to date
+
+    def propagate(self):
+        self.session.flush()
+        for flo_id, delta in self.deltas.items():
+            if delta:
+                self.session.execute(update(FileLikeObject).where(FileLikeObject.id.in_(FileLikeObject.ancestors(self.session, flo_id))).
+                        values(tree_size_bytes=func.coalesce(FileLikeObject.tree_size_bytes, 0) + delta).
+                        execution_options(synchronize_session=False))
+        FileLikeObject.refresh_subtree_fingerprints(self.session, self.deltas)
+        self.session.expire_all()
+
+    def close(self):
+        self.inotify.close()
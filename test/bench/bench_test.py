@@ -0,0 +1,43 @@
+import unittest
+import os
+import tempfile
+import filecmp
+from bench.synthetic_tree import TreeSpec, generate
+from bench import scan_bench, startup_bench
+
+class TestSyntheticTree(unittest.TestCase):
+
+    def test_same_spec_same_tree(self):
+        spec = TreeSpec(files=40, depth=2, fanout=2, median_bytes=1024, duplicate_ratio=0.25, duplicate_folders=1, jpeg_ratio=0.25)
+        with tempfile.TemporaryDirectory() as scratch:
+            first, second = os.path.join(scratch, "first"), os.path.join(scratch, "second")
+            stats = generate(first, spec)
+            generate(second, spec)
+            walked = list(os.walk(first))
+            self.assertEqual(stats.directories, len(walked))
+            self.assertEqual(stats.files, sum(len(files) for (_, _, files) in walked))
+            self.assertGreater(stats.duplicates, 0)
+            self.assertGreater(stats.jpegs, 0)
+            comparison = filecmp.dircmp(first, second)
+            self.assertEqual((comparison.left_only, comparison.right_only, comparison.diff_files), ([], [], []))
+
+class TestScanBench(unittest.TestCase):
+
+    def test_run(self):
+        spec = TreeSpec(files=30, depth=1, fanout=3, median_bytes=1024, duplicate_ratio=0.3, duplicate_folders=1, jpeg_ratio=0.2)
+        result = scan_bench.run(spec, {}, repeat=1)
+        self.assertEqual(list(result["phases"]), ["scan", "rescan_unchanged", "view_duplicates", "scan_for_duplicate_folders", "identical_folders"])
+        # Every file and directory, plus the root.
+        self.assertEqual(result["phases"]["scan"]["files"], result["tree"]["files"] + result["tree"]["directories"])
+        self.assertGreater(result["phases"]["view_duplicates"]["rows"], 0)
+        self.assertEqual(scan_bench.regressions(result, result, 0.1), [])
+
+class TestStartupBench(unittest.TestCase):
+
+    def test_run(self):
+        result = startup_bench.run(repeat=1)
+        self.assertEqual(list(result["phases"]), ["python", "import_models", "app_help", "query"])
+        # Importing is free of side effects and of the dependencies only scans need.
+        self.assertEqual(result["heavy_modules_on_import"], [])
+        self.assertEqual(result["files_left_in_working_directory"], [])
+        self.assertEqual(scan_bench.regressions(result, result, 0.1), [])
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Test modules live in per-area directories without packages; this lets them all import the
+# shared helpers next to this file (e.g. session_test_case).
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+from src.models import file as file_model
+from src.models.file import FileLikeObject, DuplicateView
+from src.models.dedupe import TieredDeduper, full_content_hash
+from session_test_case import SessionTestCase, TEST_CASE_DATA
+
+class TestTieredDeduper(SessionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        FileLikeObject.scan_recursively(FileLikeObject(path=TEST_CASE_DATA), defer_fingerprints=True)
+
+    def fingerprint_of(self, relative_path):
+        flo = file_model.session.query(FileLikeObject).filter(FileLikeObject.path == os.path.join(TEST_CASE_DATA, relative_path)).one()
+        return (flo.fingerprint_type, flo.fingerprint)
+
+    def test_only_colliding_files_are_read(self):
+        report = TieredDeduper(file_model.session).run()
+        # All four 1M files share a size; README.md's size is unique so it's never hashed.
+        self.assertEqual(report.size_groups, 1)
+        self.assertEqual(report.sampled, 4)
+        self.assertEqual(self.fingerprint_of("README.md"), (None, None))
+        # 1M_alt's imohash is unique; the other three collide and get fully hashed.
+        self.assertEqual(report.full_hashed, 3)
+        self.assertEqual(self.fingerprint_of("first_dir/1M_alt.rnd")[0], FileLikeObject.SAMPLED_FINGERPRINT_TYPE)
+        full = (FileLikeObject.FULL_FINGERPRINT_TYPE, full_content_hash(os.path.join(TEST_CASE_DATA, "first_dir/1M.rnd")))
+        self.assertEqual(self.fingerprint_of("second_dir/1M.rnd"), full)
+        self.assertEqual(self.fingerprint_of("second_dir/1M_copy.rnd"), full)
+
+    def test_confirmed_duplicates(self):
+        report = TieredDeduper(file_model.session).run()
+        self.assertEqual((report.confirmed_groups, report.confirmed_files, report.wasted_bytes), (1, 3, 2 * 1048576))
+        groups = list(TieredDeduper.confirmed_duplicates(file_model.session))
+        self.assertEqual([paths for (_, _, paths) in groups], [[
+            os.path.join(TEST_CASE_DATA, "first_dir/1M.rnd"),
+            os.path.join(TEST_CASE_DATA, "second_dir/1M.rnd"),
+            os.path.join(TEST_CASE_DATA, "second_dir/1M_copy.rnd")]])
+
+    def test_rerun_reads_nothing_new(self):
+        TieredDeduper(file_model.session).run()
+        report = TieredDeduper(file_model.session).run()
+        # The fully hashed rows are re-sampled in memory to compare against, but nothing is fully hashed again.
+        self.assertEqual(report.full_hashed, 0)
+        self.assertEqual(report.confirmed_files, 3)
+
+    def test_identical_folders_after_deferred_scan(self):
+        with tempfile.TemporaryDirectory() as root:
+            copies = [os.path.join(root, f"copy{n}") for n in range(3)]
+            for copy in copies:
+                shutil.copytree(os.path.join(TEST_CASE_DATA, "second_dir"), copy)
+            with open(os.path.join(root, "unique.txt"), "w") as f:
+                f.write("a size nothing else has")
+            self.use_db(file_model.bind_in_memory_db())
+            FileLikeObject.scan_recursively(FileLikeObject(path=root), defer_fingerprints=True)
+            TieredDeduper(file_model.session).run()
+            self.assertEqual([paths for (_, _, paths) in DuplicateView.identical_folders()], [copies])
+            # The root holds the never-hashed unique.txt, and still gets a fingerprint.
+            stored_root = file_model.session.query(FileLikeObject).filter(FileLikeObject.path == root).one()
+            self.assertNotEqual(stored_root.subtree_fingerprint, None)
@@ -0,0 +1,53 @@
+import os
+from sqlalchemy.sql import text
+from src.models import file as file_model
+from src.models.file import FileLikeObject, DuplicateGroup, DuplicateView
+from session_test_case import SessionTestCase, TEST_CASE_DATA
+
+class TestDuplicateGroups(SessionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        FileLikeObject.scan_recursively(FileLikeObject(path=TEST_CASE_DATA))
+
+    def groups(self):
+        return sorted((g.fingerprint, g.tree_size_bytes, g.member_count, g.wasted_bytes)
+                for g in file_model.session.query(DuplicateGroup))
+
+    def assert_matches_rebuild(self):
+        maintained = self.groups()
+        DuplicateGroup.rebuild(file_model.session.connection())
+        self.assertEqual(self.groups(), maintained)
+
+    def by_path(self, relative_path):
+        return file_model.session.query(FileLikeObject).filter(FileLikeObject.path == os.path.join(TEST_CASE_DATA, relative_path)).one()
+
+    def test_maintained_on_insert(self):
+        top = DuplicateGroup.top_by_wasted_bytes()
+        self.assertEqual([(g.member_count, g.wasted_bytes) for g in top], [(3, 2 * 1048576)])
+        # Directories (NULL fingerprint) are never members.
+        self.assertEqual(sum(g[2] for g in self.groups()), 5)
+        self.assertEqual(file_model.session.query(DuplicateView).count(), 3)
+        self.assert_matches_rebuild()
+
+    def test_maintained_on_update_and_delete(self):
+        copy = self.by_path("second_dir/1M_copy.rnd")
+        copy.fingerprint = "different"
+        file_model.session.delete(self.by_path("first_dir/1M.rnd"))
+        file_model.session.commit()
+        self.assertEqual([(g.member_count, g.wasted_bytes) for g in DuplicateGroup.top_by_wasted_bytes()], [])
+        self.assertEqual(file_model.session.query(DuplicateView).count(), 0)
+        self.assert_matches_rebuild()
+        copy.fingerprint = self.by_path("second_dir/1M.rnd").fingerprint
+        file_model.session.commit()
+        self.assertEqual([(g.member_count, g.wasted_bytes) for g in DuplicateGroup.top_by_wasted_bytes()], [(2, 1048576)])
+        self.assert_matches_rebuild()
+
+    def test_error_fingerprints_are_not_duplicates(self):
+        for name in ("second_dir/1M.rnd", "second_dir/1M_copy.rnd"):
+            flo = self.by_path(name)
+            flo.fingerprint = "cannot identify image file"
+            flo.fingerprint_type = "error"
+        file_model.session.commit()
+        self.assertEqual(DuplicateGroup.top_by_wasted_bytes(), [])
+        self.assert_matches_rebuild()
@@ -0,0 +1,44 @@
+import os
+import shutil
+import tempfile
+from src.models import file as file_model
+from src.models.file import FileLikeObject, DuplicateView
+from session_test_case import SessionTestCase, TEST_CASE_DATA
+
+class TestDuplicateFolders(SessionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Three copies of second_dir, plus first_dir which shares one file with them.
+        self.root = tempfile.mkdtemp()
+        for name in ("a", "b", "c"):
+            shutil.copytree(os.path.join(TEST_CASE_DATA, "second_dir"), os.path.join(self.root, name))
+        shutil.copytree(os.path.join(TEST_CASE_DATA, "first_dir"), os.path.join(self.root, "first_dir"))
+        FileLikeObject.scan_recursively(FileLikeObject(path=self.root))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        super().tearDown()
+
+    def in_root(self, *names):
+        return [os.path.join(self.root, name) for name in names]
+
+    def test_identical_folders(self):
+        groups = list(DuplicateView.identical_folders())
+        self.assertEqual(len(groups), 1)
+        _, size, paths = groups[0]
+        self.assertEqual(size, 2 * 1048576)
+        self.assertEqual(paths, self.in_root("a", "b", "c"))
+
+    def test_renamed_file_breaks_identity(self):
+        os.rename(os.path.join(self.root, "c", "1M_copy.rnd"), os.path.join(self.root, "c", "renamed.rnd"))
+        FileLikeObject.scan_recursively(FileLikeObject(path=self.root), incremental=True)
+        _, _, paths = list(DuplicateView.identical_folders())[0]
+        self.assertEqual(paths, self.in_root("a", "b"))
+
+    def test_overlap_counts_every_pair(self):
+        overlaps = DuplicateView.scan_for_duplicate_folders()
+        a, b, c, first_dir = self.in_root("a", "b", "c", "first_dir")
+        # a, b and c each hold the same two files twice over (one fingerprint); first_dir shares it too.
+        self.assertEqual(sorted(overlaps), sorted([(x, y, 1) for (x, y) in
+            [(a, b), (a, c), (b, c), (a, first_dir), (b, first_dir), (c, first_dir)]]))
@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+from src.models import file as file_model
+from src.models.file import FileLikeObject, ScanSession, ScanCheckpoint
+from session_test_case import SessionTestCase, TEST_CASE_DATA
+
+class Interrupted(Exception):
+    pass
+
+class TestCheckpointResume(SessionTestCase):
+
+    def scanned(self):
+        return {f.path: (f.tree_size_bytes, f.fingerprint, f.subtree_fingerprint) for f in file_model.session.query(FileLikeObject)}
+
+    def interrupted_scan(self, root=TEST_CASE_DATA, **options):
+        """
+        Scan root (a copy of the test data), but die fingerprinting the first file in the second of first_dir
+        and second_dir to be walked. Returns that directory.
+        """
+        fingerprint_file = FileLikeObject.fingerprint_file
+        seen = []
+        def dying(path, hash_content=True):
+            directory = os.path.dirname(path)
+            if directory != root and directory not in seen:
+                seen.append(directory)
+            if len(seen) == 2:
+                raise Interrupted()
+            return fingerprint_file(path, hash_content)
+        with mock.patch.object(FileLikeObject, "fingerprint_file", side_effect=dying):
+            with self.assertRaises(Interrupted):
+                FileLikeObject.scan_recursively(FileLikeObject(path=root), **options)
+        file_model.session.rollback()
+        return seen[1]
+
+    def check_resume(self, **options):
+        FileLikeObject.scan_recursively(FileLikeObject(path=TEST_CASE_DATA))
+        clean = self.scanned()
+        self.use_db(file_model.bind_in_memory_db())
+
+        unfinished = self.interrupted_scan(**options)
+        scan = file_model.session.query(ScanSession).one()
+        self.assertEqual(scan.finished, None)
+        checkpointed = {file_model.session.get(FileLikeObject, c.directory_id).path for c in file_model.session.query(ScanCheckpoint)}
+        self.assertEqual(len(checkpointed), 1)
+        self.assertNotIn(unfinished, checkpointed)
+
+        progress = FileLikeObject.scan_recursively(FileLikeObject(path=TEST_CASE_DATA), resume=True, **options)
+        self.assertEqual(progress.resumed, 1)
+        # The finished directory's two files are never looked at again.
+        self.assertEqual(progress.instruments.as_dict()["lstat"]["calls"], 6)
+        self.assertEqual(self.scanned(), clean)
+        scan = file_model.session.query(ScanSession).one()
+        self.assertEqual((scan.resumes, scan.files_processed), (1, 6))
+        self.assertNotEqual(scan.finished, None)
+        self.assertEqual(file_model.session.query(ScanCheckpoint).count(), 0)
+
+    def test_resume(self):
+        self.check_resume(batch_size=1)
+
+    def test_resume_bulk(self):
+        self.check_resume(bulk=True, batch_size=1)
+
+    def test_without_resume_starts_over(self):
+        self.interrupted_scan(batch_size=1)
+        progress = FileLikeObject.scan_recursively(FileLikeObject(path=TEST_CASE_DATA))
+        self.assertEqual((progress.resumed, progress.files_processed), (0, 8))
+        self.assertEqual(file_model.session.query(ScanSession).filter(ScanSession.finished != None).count(), 1)
+
+    def test_resume_after_a_finished_scan_starts_over(self):
+        with tempfile.TemporaryDirectory() as scratch:
+            root = os.path.join(scratch, "data")
+            shutil.copytree(TEST_CASE_DATA, root)
+            unfinished = self.interrupted_scan(root, batch_size=1)
+            finished = os.path.join(root, ({"first_dir", "second_dir"} - {os.path.basename(unfinished)}).pop())
+            FileLikeObject.scan_recursively(FileLikeObject(path=root))
+            self.assertEqual(file_model.session.query(ScanCheckpoint).count(), 0)
+            # Changed after the complete scan: the interrupted scan's checkpoint must not hide it.
+            changed = os.path.join(finished, sorted(os.listdir(finished))[0])
+            with open(changed, "ab") as f:
+                f.write(b"grown")
+            progress = FileLikeObject.scan_recursively(FileLikeObject(path=root), resume=True)
+            self.assertEqual(progress.resumed, 0)
+            stored = file_model.session.query(FileLikeObject).filter(FileLikeObject.path == changed). \
+                    order_by(FileLikeObject.id.desc()).first()
+            self.assertEqual(stored.tree_size_bytes, os.path.getsize(changed))
+
+    def test_resume_before_any_directory_finished(self):
+        with tempfile.TemporaryDirectory() as root:
+            for n in range(10):
+                with open(os.path.join(root, f"{n}.bin"), "wb") as f:
+                    f.write(bytes([n]) * 100)
+            # Killed after six files were written, before the only directory could finish.
+            fingerprint_file = FileLikeObject.fingerprint_file
+            calls = []
+            def dying(path, hash_content=True):
+                calls.append(path)
+                if len(calls) == 7:
+                    raise Interrupted()
+                return fingerprint_file(path, hash_content)
+            with mock.patch.object(FileLikeObject, "fingerprint_file", side_effect=dying):
+                with self.assertRaises(Interrupted):
+                    FileLikeObject.scan_recursively(FileLikeObject(path=root), batch_size=1)
+            file_model.session.rollback()
+            self.assertEqual(file_model.session.query(ScanCheckpoint).count(), 0)
+            progress = FileLikeObject.scan_recursively(FileLikeObject(path=root), resume=True)
+            self.assertEqual((progress.resumed, progress.skipped, progress.fingerprinted), (0, 6, 4))
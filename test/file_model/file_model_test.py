@@ -1,6 +1,11 @@
 import unittest
 import io
+import os
+import sys
+import tempfile
+from src.models import file as file_model
 from src.models.file import FileLikeObject
+from session_test_case import SessionTestCase, TEST_CASE_DATA
 
 class TestFileLikeObject(unittest.TestCase):
 
@@ -8,3 +13,68 @@ class TestFileLikeObject(unittest.TestCase):
         self_file = FileLikeObject.create(__file__)
         assert(True)
 
+class TestIncrementalScan(SessionTestCase):
+
+    def test_rescan_skips_unchanged_files(self):
+        first = FileLikeObject.scan_recursively(FileLikeObject(path=TEST_CASE_DATA))
+        self.assertEqual(first.fingerprinted, 5)
+        self.assertEqual(first.skipped, 0)
+        rows = file_model.session.query(FileLikeObject).count()
+        fingerprints = {f.path: f.fingerprint for f in file_model.session.query(FileLikeObject)}
+
+        second = FileLikeObject.scan_recursively(FileLikeObject(path=TEST_CASE_DATA), incremental=True)
+        self.assertEqual(second.fingerprinted, 0)
+        self.assertEqual(second.skipped, 5)
+        self.assertEqual(file_model.session.query(FileLikeObject).count(), rows)
+        self.assertEqual({f.path: f.fingerprint for f in file_model.session.query(FileLikeObject)}, fingerprints)
+
+    def test_deeper_than_recursion_limit(self):
+        root = tempfile.mkdtemp()
+        depth = sys.getrecursionlimit() + 100
+        leaf = root
+        for _ in range(depth):      # os.makedirs and shutil.rmtree recurse too
+            leaf = os.path.join(leaf, "d")
+            os.mkdir(leaf)
+        with open(os.path.join(leaf, "leaf.txt"), "w") as f:
+            f.write("leaf")
+        try:
+            progress = FileLikeObject.scan_recursively(FileLikeObject(path=root))
+            self.assertEqual(progress.files_processed, depth + 2)
+            stored_root = file_model.session.query(FileLikeObject).filter(FileLikeObject.path == os.path.abspath(root)).one()
+            self.assertEqual(stored_root.tree_size_bytes, 4)
+        finally:
+            os.remove(os.path.join(leaf, "leaf.txt"))
+            while leaf != root:
+                os.rmdir(leaf)
+                leaf = os.path.dirname(leaf)
+            os.rmdir(root)
+
+    def test_full_rescan_refingerprints(self):
+        FileLikeObject.scan_recursively(FileLikeObject(path=TEST_CASE_DATA))
+        second = FileLikeObject.scan_recursively(FileLikeObject(path=TEST_CASE_DATA))
+        self.assertEqual(second.fingerprinted, 5)
+        self.assertEqual(second.skipped, 0)
+
+class TestBulkIngestion(SessionTestCase):
+
+    def scanned_rows(self, **scan_args):
+        self.use_db(file_model.bind_in_memory_db())
+        FileLikeObject.scan_recursively(FileLikeObject(path=TEST_CASE_DATA), **scan_args)
+        FileLikeObject.scan_recursively(FileLikeObject(path=TEST_CASE_DATA), **scan_args)
+        # last_stat (and possibly atime) differ between any two scans; everything else should not.
+        rows = [(f.id, f.path, f.permissions, f.tree_size_bytes, f.directory, f.inode, f.dev_number, f.mime,
+                 f.fingerprint, f.fingerprint_type, f.last_modified, f.creation_or_meta)
+                for f in file_model.session.query(FileLikeObject).order_by(FileLikeObject.id)]
+        return rows
+
+    def test_bulk_matches_orm_ingestion(self):
+        orm_rows = self.scanned_rows()
+        self.assertEqual(self.scanned_rows(bulk=True, batch_size=3), orm_rows)
+        self.assertEqual(self.scanned_rows(bulk=True, incremental=True), orm_rows)
+
+    def test_pipeline_matches_orm_ingestion(self):
+        # Results come back in completion order, so only the ids are allowed to differ.
+        without_ids = lambda rows: sorted(r[1:] for r in rows)
+        orm_rows = without_ids(self.scanned_rows())
+        self.assertEqual(without_ids(self.scanned_rows(workers=3, batch_size=2)), orm_rows)
+        self.assertEqual(without_ids(self.scanned_rows(workers=2, use_processes=True, incremental=True)), orm_rows)
@@ -0,0 +1,35 @@
+import os
+from src.models import file as file_model
+from src.models.file import FileLikeObject
+from src.models.instrumentation import PhaseStats
+from session_test_case import SessionTestCase, TEST_CASE_DATA
+
+class TestInstrumentation(SessionTestCase):
+
+    def check_phases(self, phases):
+        # 8 entries, the root looked up before the walk; 3 directories listed; 5 regular files fingerprinted.
+        self.assertEqual(phases["lstat"]["calls"], 8)
+        self.assertEqual(phases["lookup"]["calls"], 7)
+        self.assertEqual(phases["scandir"]["calls"], 3)
+        self.assertEqual(phases["magic"]["calls"], 5)
+        # imohash reads three 16K samples of each 1M file, and README.md whole.
+        self.assertEqual(phases["imohash"]["bytes_read"], 4 * 3 * 16384 + os.path.getsize(os.path.join(TEST_CASE_DATA, "README.md")))
+        self.assertGreater(phases["commit"]["calls"], 0)
+        self.assertEqual(sum(phases["lstat"]["histogram_us"].values()), 8)
+
+    def test_serial_scan(self):
+        progress = FileLikeObject.scan_recursively(FileLikeObject(path=TEST_CASE_DATA))
+        self.check_phases(progress.instruments.as_dict())
+
+    def test_pipelined_scan(self):
+        progress = FileLikeObject.scan_recursively(FileLikeObject(path=TEST_CASE_DATA), workers=2, use_processes=True)
+        phases = progress.instruments.as_dict()
+        self.check_phases(phases)
+        self.assertEqual(phases["load_index"]["calls"], 1)
+
+    def test_histogram(self):
+        stats = PhaseStats()
+        for seconds in [0.0000005, 0.000003, 0.000003, 0.001]:
+            stats.record(seconds)
+        self.assertEqual(stats.as_dict()["histogram_us"], {"<1": 1, "<4": 2, "<1024": 1})
+        self.assertEqual((stats.percentile_us(0.5), stats.percentile_us(0.99)), (4, 1024))
@@ -0,0 +1,56 @@
+import os
+from sqlalchemy.sql import text
+from src.models import file as file_model
+from src.models.file import FileLikeObject, DatabaseSetting, DuplicateView
+from src.models.paths import PathResolver, COMPACT_PATHS_SETTING, is_compact, migrate_to_compact
+from src.models.dedupe import TieredDeduper
+from session_test_case import SessionTestCase, TEST_CASE_DATA
+
+class TestCompactPaths(SessionTestCase):
+
+    def resolved(self):
+        resolver = PathResolver(file_model.session)
+        return {resolver.full_path(f): (f.inode, f.tree_size_bytes, f.fingerprint, f.subtree_fingerprint)
+                for f in file_model.session.query(FileLikeObject)}
+
+    def stored_paths(self):
+        return file_model.session.execute(text("SELECT COUNT(*) FROM filelikes WHERE path IS NOT NULL")).scalar()
+
+    def test_parents_are_linked(self):
+        FileLikeObject.scan_recursively(FileLikeObject(path=TEST_CASE_DATA))
+        for flo in file_model.session.query(FileLikeObject):
+            if flo.path == TEST_CASE_DATA:
+                self.assertEqual((flo.parent_id, flo.name), (None, TEST_CASE_DATA))
+            else:
+                self.assertEqual(os.path.join(flo.parent.path, flo.name), flo.path)
+
+    def test_compact_scan(self):
+        FileLikeObject.scan_recursively(FileLikeObject(path=TEST_CASE_DATA))
+        full = self.resolved()
+        self.use_db(file_model.bind_in_memory_db())
+        DatabaseSetting.put(file_model.session, COMPACT_PATHS_SETTING, "1")
+        FileLikeObject.scan_recursively(FileLikeObject(path=TEST_CASE_DATA))
+        self.assertEqual(self.stored_paths(), 0)
+        self.assertEqual(self.resolved(), full)
+        # Rescans find the stored rows from their names and parents alone.
+        progress = FileLikeObject.scan_recursively(FileLikeObject(path=TEST_CASE_DATA), incremental=True)
+        self.assertEqual((progress.skipped, progress.fingerprinted), (5, 0))
+        self.assertEqual(self.resolved(), full)
+        self.assertEqual(TieredDeduper(file_model.session).run().confirmed_files, 3)
+        self.assertEqual([os.path.basename(a) + "," + os.path.basename(b) for (a, b, _) in DuplicateView.scan_for_duplicate_folders()],
+                ["first_dir,second_dir"])
+
+    def test_migration(self):
+        FileLikeObject.scan_recursively(FileLikeObject(path=TEST_CASE_DATA))
+        full = self.resolved()
+        # As if scanned before parents and names were recorded.
+        file_model.session.execute(text("UPDATE filelikes SET parent_id = NULL, name = NULL"))
+        file_model.session.commit()
+        migrate_to_compact(file_model.session.get_bind())
+        self.assertTrue(is_compact(file_model.session))
+        self.assertEqual(self.stored_paths(), 0)
+        self.assertEqual(self.resolved(), full)
+        self.assertEqual(file_model.session.query(DuplicateView).count(), 3)
+        progress = FileLikeObject.scan_recursively(FileLikeObject(path=os.path.join(TEST_CASE_DATA, "first_dir")), incremental=True)
+        self.assertEqual((progress.skipped, progress.fingerprinted), (2, 0))
+        self.assertEqual(self.resolved(), full)
@@ -0,0 +1,66 @@
+import os
+import tempfile
+from src.models import file as file_model
+from src.models.file import FileLikeObject, DatabaseSetting, DuplicateView, DuplicateGroup
+from src.models.paths import PathResolver, COMPACT_PATHS_SETTING
+from src.models.merge import merge_shards
+from session_test_case import SessionTestCase, TEST_CASE_DATA
+
+class TestMerge(SessionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.scratch = tempfile.TemporaryDirectory()
+        # Each "host" scans one of the two directories.
+        self.shards = [self.scan_shard("alpha", "first_dir"), self.scan_shard("beta", "second_dir", compact=True)]
+        self.use_db(file_model.bind_file_db(os.path.join(self.scratch.name, "central.sqlite")))
+
+    def tearDown(self):
+        super().tearDown()
+        self.scratch.cleanup()
+
+    def scan_shard(self, host, directory, compact=False, name=None):
+        path = os.path.join(self.scratch.name, f"{name or host}.sqlite")
+        self.use_db(file_model.bind_file_db(path))
+        DatabaseSetting.put(file_model.session, DatabaseSetting.HOST_SETTING, host)
+        if compact:
+            DatabaseSetting.put(file_model.session, COMPACT_PATHS_SETTING, "1")
+        FileLikeObject.scan_recursively(FileLikeObject(path=os.path.join(TEST_CASE_DATA, directory)))
+        return path
+
+    def merged(self):
+        resolver = PathResolver(file_model.session)
+        return sorted((f.host, resolver.full_path(f), f.tree_size_bytes) for f in file_model.session.query(FileLikeObject))
+
+    def test_merge(self):
+        self.assertEqual(merge_shards(file_model.session.get_bind(), self.shards), 6)
+        merged = self.merged()
+        self.assertEqual([(host, os.path.relpath(path, TEST_CASE_DATA)) for (host, path, _) in merged], [
+            ("alpha", "first_dir"), ("alpha", "first_dir/1M.rnd"), ("alpha", "first_dir/1M_alt.rnd"),
+            ("beta", "second_dir"), ("beta", "second_dir/1M.rnd"), ("beta", "second_dir/1M_copy.rnd")])
+        # Links survive the id offsets.
+        resolver = PathResolver(file_model.session)
+        for flo in file_model.session.query(FileLikeObject).filter(FileLikeObject.parent_id != None):
+            self.assertEqual((flo.parent.host, resolver.full_path(flo.parent)), (flo.host, os.path.dirname(resolver.full_path(flo))))
+        # Duplicates across hosts, from duplicate_groups rebuilt after the copy.
+        self.assertEqual(file_model.session.query(DuplicateView).count(), 3)
+        self.assertEqual(DuplicateGroup.top_by_wasted_bytes(1)[0].member_count, 3)
+        self.assertEqual([(a, b) for (a, b, _) in DuplicateView.scan_for_duplicate_folders()],
+                [(f"alpha:{TEST_CASE_DATA}/first_dir", f"beta:{TEST_CASE_DATA}/second_dir")])
+
+    def test_merge_again_replaces(self):
+        merge_shards(file_model.session.get_bind(), self.shards)
+        first = self.merged()
+        merge_shards(file_model.session.get_bind(), self.shards[1:])
+        self.assertEqual(self.merged(), first)
+        self.assertEqual(file_model.session.query(DuplicateView).count(), 3)
+
+    def test_merge_again_keeps_other_shards_of_the_host(self):
+        # One DB per disk on the same machine: re-merging one mustn't drop the other's trees.
+        shards = [self.scan_shard("gamma", "first_dir", name="vol0"), self.scan_shard("gamma", "second_dir", name="vol1")]
+        self.use_db(file_model.bind_file_db(os.path.join(self.scratch.name, "central.sqlite")))
+        merge_shards(file_model.session.get_bind(), shards)
+        first = self.merged()
+        self.assertEqual(set(host for (host, _, _) in first), {"gamma"})
+        merge_shards(file_model.session.get_bind(), shards[1:])
+        self.assertEqual(self.merged(), first)
@@ -0,0 +1,115 @@
+import io
+import os
+import sys
+import csv
+import json
+import tempfile
+import subprocess
+from src.models import file as file_model
+from src.models.file import FileLikeObject, DatabaseSetting, DuplicateView, DuplicateGroup
+from src.models.paths import PathResolver, COMPACT_PATHS_SETTING
+from src.models.reports import DuplicateFilesReport, LargestReport, DuplicateFoldersReport, MEMBER_CONDITION, write_jsonl, write_csv
+from session_test_case import SessionTestCase
+
+class TestReports(SessionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.scratch = tempfile.TemporaryDirectory()
+        self.root = self.scratch.name
+        # Two identical folders, some duplicates of differing sizes across others, and unique files.
+        for folder in ["same1", "same2", "other"]:
+            os.makedirs(os.path.join(self.root, folder))
+        for folder in ["same1", "same2"]:
+            for n in range(3):
+                self.write(f"{folder}/f{n}.bin", bytes([n]) * (100 * (n + 1)))
+        for n in range(4):
+            self.write(f"other/copy{n}.bin", b"c" * 1000)
+            self.write(f"other/unique{n}.bin", bytes([n + 10]) * 10)
+
+    def tearDown(self):
+        self.scratch.cleanup()
+        super().tearDown()
+
+    def write(self, relative_path, data):
+        with open(os.path.join(self.root, relative_path), "wb") as f:
+            f.write(data)
+
+    def scan(self):
+        FileLikeObject.scan_recursively(FileLikeObject(path=self.root))
+
+    def check_reports(self):
+        session = file_model.session
+        resolver = PathResolver(session)
+        # Reports read through plain sqlite3; this is the session's own connection, so it sees the same in-memory DB.
+        connection = session.connection().connection.dbapi_connection
+        # Page sizes that split groups across pages give the same rows as one big page.
+        for report in [DuplicateFilesReport, LargestReport, DuplicateFoldersReport]:
+            self.assertEqual(list(report(page_size=2).rows(connection)), list(report(page_size=1000).rows(connection)))
+
+        duplicates = list(DuplicateFilesReport(page_size=2).rows(connection))
+        self.assertEqual(sorted(row[-1] for row in duplicates),
+                sorted(resolver.full_path(row) for row in session.query(DuplicateView)))
+        self.assertEqual([row[0] for row in duplicates], sorted((row[0] for row in duplicates), reverse=True))
+        self.assertEqual(duplicates[0][2:4], (1000, 4))
+        self.assertEqual(len(set(row[4] for row in duplicates)), len(duplicates))
+
+        largest = list(LargestReport(page_size=2).rows(connection))
+        names = [os.path.relpath(row[-1], self.root) for row in largest]
+        self.assertEqual((names[:2], sorted(names[2:])), ([".", "other"], ["same1", "same2"]))
+        self.assertTrue(all(row[1] for row in largest))
+        sizes = [row[0] for row in LargestReport(page_size=3, files=True).rows(connection)]
+        self.assertEqual(sizes, sorted(sizes, reverse=True))
+        self.assertEqual(len(sizes), session.query(FileLikeObject).count())
+
+        folders = list(DuplicateFoldersReport(page_size=1).rows(connection))
+        self.assertEqual(sorted(os.path.relpath(row[-1], self.root) for row in folders), ["same1", "same2"])
+        self.assertEqual(len(set(row[1] for row in folders)), 1)
+
+    def test_reports(self):
+        self.scan()
+        self.check_reports()
+
+    def test_reports_compact(self):
+        DatabaseSetting.put(file_model.session, COMPACT_PATHS_SETTING, "1")
+        self.scan()
+        self.check_reports()
+
+    def test_pages_are_index_ranges(self):
+        self.scan()
+        connection = file_model.session.connection().connection.dbapi_connection
+        plan = lambda query: [row[-1] for row in connection.execute(f"EXPLAIN QUERY PLAN {query[0]}", query[1])]
+        # Later pages start inside the index rather than scanning filelikes (or all of duplicate_groups) again.
+        duplicates = plan(DuplicateFilesReport(page_size=10).query((100, "x", 100)))
+        self.assertIn("SEARCH duplicate_groups USING INDEX ix_duplicate_groups_wasted_bytes_fingerprint_tree_size_bytes "
+                "((wasted_bytes,fingerprint,tree_size_bytes)<(?,?,?))", duplicates)
+        self.assertIn("SEARCH f USING INDEX ix_filelikes_fingerprint (fingerprint=?)", duplicates)
+        folders = plan(DuplicateFoldersReport(page_size=10).query((100, "x", 100)))
+        self.assertTrue(folders[0].startswith("SEARCH f USING INDEX ix_filelikes_tree_size_bytes_subtree_fingerprint"), folders)
+        self.assertFalse(any("TEMP B-TREE" in line for line in folders), folders)
+
+    def test_member_condition(self):
+        self.assertEqual(MEMBER_CONDITION, DuplicateGroup.member_condition("f"))
+
+    def test_query_needs_an_existing_db(self):
+        db = os.path.join(self.root, "typo.sqlite")
+        query = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, "query.py")
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        result = subprocess.run([sys.executable, query, "largest", "--db", db], env=env, capture_output=True)
+        self.assertNotEqual(result.returncode, 0)
+        self.assertFalse(os.path.exists(db))
+
+    def test_reports_skip_sqlalchemy(self):
+        script = "import sys, src.models.reports; print('sqlalchemy' in sys.modules)"
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        self.assertEqual(subprocess.run([sys.executable, "-c", script], env=env, capture_output=True, text=True).stdout.strip(), "False")
+
+    def test_writers(self):
+        rows = [(1, "a,b", None), (2, "ü", True)]
+        out = io.StringIO()
+        self.assertEqual(write_jsonl(("n", "s", "x"), iter(rows), out), 2)
+        self.assertEqual([json.loads(line) for line in out.getvalue().splitlines()],
+                [{"n": 1, "s": "a,b", "x": None}, {"n": 2, "s": "ü", "x": True}])
+        out = io.StringIO()
+        self.assertEqual(write_csv(("n", "s", "x"), iter(rows), out), 2)
+        self.assertEqual(list(csv.reader(io.StringIO(out.getvalue()))), [["n", "s", "x"], ["1", "a,b", ""], ["2", "ü", "True"]])
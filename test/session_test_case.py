@@ -0,0 +1,30 @@
+import os
+import unittest
+from src.models import file as file_model
+
+TEST_CASE_DATA = os.path.abspath(os.path.join(os.path.dirname(__file__), "test_case_data"))
+
+class SessionTestCase(unittest.TestCase):
+    """
+    Runs each test against a fresh in-memory DB as src.models.file.session, and puts back whatever
+    session was there before afterwards.
+    """
+
+    def setUp(self):
+        self.saved_session = file_model.session
+        file_model.session = None
+        self.use_db(file_model.bind_in_memory_db())
+
+    def tearDown(self):
+        if file_model.session != None:
+            file_model.session.close()
+        file_model.session = self.saved_session
+
+    def use_db(self, session):
+        """
+        Make session the DB for the rest of the test, closing the one it replaces.
+        """
+        if file_model.session != None:
+            file_model.session.close()
+        file_model.session = session
+        return session
@@ -0,0 +1,67 @@
+import os
+import random
+import tempfile
+from PIL import Image
+from src.models import file as file_model
+from src.models.file import FileLikeObject, ImageMetadata
+from src.models.similar import perceptual_hash, distance, bands, within_radius, MultiIndexHash, similar_to, near_duplicate_images
+from session_test_case import SessionTestCase
+
+def photo(seed):
+    """
+    Something with structure at every scale, like a photo: random blocks, blurred by upscaling.
+    """
+    rng = random.Random(seed)
+    blocks = Image.new("RGB", (16, 12))
+    blocks.putdata([tuple(rng.randrange(256) for _ in range(3)) for _ in range(16 * 12)])
+    return blocks.resize((1024, 768), Image.BICUBIC)
+
+class TestPerceptualHash(SessionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.scratch = tempfile.TemporaryDirectory()
+        self.dir = self.scratch.name
+        photo(1).save(os.path.join(self.dir, "original.jpg"), quality=95)
+        photo(1).resize((300, 225)).save(os.path.join(self.dir, "small_copy.jpg"), quality=50)
+        photo(1).save(os.path.join(self.dir, "copy.png"))
+        photo(2).save(os.path.join(self.dir, "other.jpg"), quality=95)
+
+    def tearDown(self):
+        self.scratch.cleanup()
+        super().tearDown()
+
+    def hash_of(self, name):
+        return perceptual_hash(os.path.join(self.dir, name))
+
+    def test_resized_and_reencoded_copies_match(self):
+        original = self.hash_of("original.jpg")
+        self.assertLessEqual(distance(original, self.hash_of("small_copy.jpg")), 4)
+        self.assertLessEqual(distance(original, self.hash_of("copy.png")), 4)
+        self.assertGreater(distance(original, self.hash_of("other.jpg")), 16)
+
+    def test_multi_index_hash(self):
+        rng = random.Random(3)
+        hashes = [rng.getrandbits(64) for _ in range(500)]
+        # Plant some near neighbours of the first hash.
+        hashes.extend(hashes[0] ^ (1 << bit) ^ (1 << (bit + 20)) for bit in range(10))
+        index = MultiIndexHash()
+        for (n, value) in enumerate(hashes):
+            index.add(n, value)
+        for k in [2, 5, 9]:
+            brute = {(a, b) for a in range(len(hashes)) for b in range(a + 1, len(hashes)) if distance(hashes[a], hashes[b]) <= k}
+            self.assertEqual({(a, b) for (a, b, _) in index.pairs(k)}, brute)
+        self.assertEqual(len(list(within_radius(0, 2))), 1 + 16 + 120)
+
+    def test_scan_stores_hashes(self):
+        FileLikeObject.scan_recursively(FileLikeObject(path=self.dir))
+        meta = file_model.session.query(ImageMetadata).join(ImageMetadata.file).filter(FileLikeObject.name == "original.jpg").one()
+        original = self.hash_of("original.jpg")
+        self.assertEqual(int(meta.perceptual_hash, 16), original)
+        self.assertEqual([meta.perceptual_band_0, meta.perceptual_band_1, meta.perceptual_band_2, meta.perceptual_band_3], bands(original))
+        similar = similar_to(file_model.session, original, 6)
+        self.assertEqual(sorted(file_model.session.get(FileLikeObject, file_id).name for (file_id, _) in similar),
+                ["copy.png", "original.jpg", "small_copy.jpg"])
+        self.assertEqual(similar[0][1], 0)
+        pairs = [(os.path.basename(a), os.path.basename(b)) for (a, b, _) in near_duplicate_images(file_model.session, 6)]
+        self.assertEqual(sorted(pairs), [("copy.png", "original.jpg"), ("copy.png", "small_copy.jpg"), ("original.jpg", "small_copy.jpg")])
@@ -0,0 +1,110 @@
+import unittest
+import os
+import shutil
+import tempfile
+from src.models import file as file_model
+from src.models.file import FileLikeObject, DatabaseSetting, ScanSession
+from src.models.paths import PathResolver, COMPACT_PATHS_SETTING
+from src.models.watch import Watcher, ChangeSet, IN_CREATE, IN_MOVED_FROM, IN_MOVED_TO, IN_DELETE, IN_ISDIR
+from session_test_case import SessionTestCase
+
+class TestChangeSet(unittest.TestCase):
+
+    def test_coalescing(self):
+        changes = ChangeSet()
+        changes.add("/r", "a", IN_CREATE | IN_ISDIR, 0)
+        changes.add("/r/a", "x", IN_CREATE, 0)
+        changes.add("/r", "b", IN_DELETE, 0)
+        changes.add("/r", "a", IN_MOVED_FROM | IN_ISDIR, 7)
+        changes.add("/r", "b", IN_MOVED_TO | IN_ISDIR, 7)
+        changes.add("/r", "gone", IN_MOVED_FROM, 8)
+        # Changes follow the rename; what was at the destination is superseded by it.
+        self.assertEqual(changes.moves, [("/r/a", "/r/b", True)])
+        self.assertEqual(changes.ops, {"/r/b/x": "refresh", "/r/gone": "delete"})
+
+class TestWatcher(SessionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.scratch = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.scratch.name, "root")
+        for directory in ["a", "a/sub", "b"]:
+            os.makedirs(os.path.join(self.root, directory))
+        self.write("a/x.bin", b"x" * 100)
+        self.write("a/sub/y.bin", b"y" * 1000)
+        self.write("a/sub/z.bin", b"z" * 10)
+        self.write("b/w.bin", b"w" * 5)
+
+    def tearDown(self):
+        self.watcher.close()
+        self.scratch.cleanup()
+        super().tearDown()
+
+    def write(self, relative_path, data):
+        with open(os.path.join(self.root, relative_path), "ab") as f:
+            f.write(data)
+
+    def path(self, relative_path):
+        return os.path.join(self.root, relative_path)
+
+    def stored(self):
+        resolver = PathResolver(file_model.session)
+        return {os.path.relpath(resolver.full_path(f), self.root): (f.tree_size_bytes, f.fingerprint, f.subtree_fingerprint)
+                for f in file_model.session.query(FileLikeObject)}
+
+    def rescanned(self):
+        """
+        What a full scan of the tree as it is now stores.
+        """
+        saved = file_model.session
+        file_model.session = file_model.bind_in_memory_db()
+        try:
+            FileLikeObject.scan_recursively(FileLikeObject(path=self.root))
+            return self.stored()
+        finally:
+            file_model.session.close()
+            file_model.session = saved
+
+    def settle(self):
+        self.assertTrue(self.watcher.process(timeout=2))
+
+    def check_changes(self):
+        self.watcher = Watcher(file_model.session, [self.root], debounce=0.1)
+        self.watcher.start()
+        y = file_model.session.query(FileLikeObject).filter(FileLikeObject.name == "y.bin").one()
+        y_id, y_stat = y.id, y.last_stat
+        scans = file_model.session.query(ScanSession).count()
+
+        self.write("a/new.bin", b"n" * 50)
+        self.write("a/x.bin", b"x" * 7)
+        self.settle()
+        self.assertEqual(self.stored(), self.rescanned())
+
+        # Directory rename: rows follow without being fingerprinted again.
+        os.rename(self.path("a/sub"), self.path("b/sub2"))
+        self.settle()
+        self.assertEqual(self.stored(), self.rescanned())
+        y = file_model.session.get(FileLikeObject, y_id)
+        self.assertEqual((PathResolver(file_model.session).full_path(y), y.last_stat), (self.path("b/sub2/y.bin"), y_stat))
+
+        # Events under the renamed directory land on the right rows.
+        os.remove(self.path("b/sub2/z.bin"))
+        self.write("b/sub2/y.bin", b"y")
+        os.makedirs(self.path("b/sub2/deeper/deepest"))
+        self.write("b/sub2/deeper/deepest/v.bin", b"v" * 3)
+        self.settle()
+        self.assertEqual(self.stored(), self.rescanned())
+        # New directories are walked as part of the batch, not as scans of their own.
+        self.assertEqual(file_model.session.query(ScanSession).count(), scans)
+
+        shutil.rmtree(self.path("b/sub2"))
+        os.rename(self.path("a/x.bin"), self.path("b/w.bin"))
+        self.settle()
+        self.assertEqual(self.stored(), self.rescanned())
+
+    def test_changes(self):
+        self.check_changes()
+
+    def test_changes_compact(self):
+        DatabaseSetting.put(file_model.session, COMPACT_PATHS_SETTING, "1")
+        self.check_changes()